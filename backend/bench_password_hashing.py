@@ -0,0 +1,63 @@
+"""
+Benchmark login throughput with the configured password hashing cost.
+
+Runs a burst of concurrent password verifications through the same capped
+hashing pool the /login endpoint uses and reports verifications per second.
+This measures the KDF only: /login also does a user lookup and a session
+insert (both in the threadpool), so real login throughput also depends on
+database round-trip time.
+Usage: python bench_password_hashing.py [number_of_logins]
+"""
+import asyncio
+import sys
+import time
+
+import security
+
+LOGINS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+
+async def main():
+    stored = security.hash_password_sync("correct horse battery staple")
+
+    # Single hash latency
+    start = time.perf_counter()
+    security.verify_password_sync("correct horse battery staple", stored)
+    single = time.perf_counter() - start
+
+    # Concurrent login storm, plus a probe measuring event loop responsiveness
+    lags = []
+
+    async def probe():
+        while True:
+            tick = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - tick - 0.01)
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        security.verify_password("correct horse battery staple", stored)
+        for _ in range(LOGINS)
+    ])
+    elapsed = time.perf_counter() - start
+    probe_task.cancel()
+
+    assert all(results)
+
+    print("=" * 50)
+    print("Password Hashing Benchmark")
+    print("=" * 50)
+    print(f"scrypt cost: N={security.SCRYPT_N} r={security.SCRYPT_R} p={security.SCRYPT_P}")
+    print(f"Hashing workers: {security.HASH_WORKERS}")
+    print(f"Single verification: {single * 1000:.1f} ms")
+    print(f"{LOGINS} concurrent verifications in {elapsed:.2f} s -> {LOGINS / elapsed:.1f} verifications/sec")
+    print("(KDF only - excludes the user lookup and session insert done by /login)")
+    if lags:
+        print(f"Max event loop lag during storm: {max(lags) * 1000:.1f} ms")
+
+    security.shutdown_hash_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
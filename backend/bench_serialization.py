@@ -0,0 +1,124 @@
+"""
+Benchmark response serialization and compression for the largest payloads.
+
+Compares the old path (per-document str(_id)/isoformat() loop, FastAPI's
+jsonable_encoder, stdlib json) against BSONJSONResponse, and reports the bytes
+on the wire with and without gzip/brotli for a /conversations page and a
+/generate-lecture response.
+Usage: python bench_serialization.py [iterations]
+"""
+import gzip
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from responses import BSONJSONResponse, brotli, orjson
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+WORDS = (
+    "photosynthesis converts light energy into chemical stored glucose happens two stages "
+    "dependent reactions thylakoid membranes calvin cycle stroma chlorophyll absorbs carbon "
+    "dioxide water oxygen released plants leaves enzyme rubisco fixes atp nadph produced"
+).split()
+_rng = random.Random(42)
+
+
+def answer_text(words=180):
+    """Varied prose so compression ratios aren't flattered by exact repeats"""
+    return " ".join(_rng.choice(WORDS) for _ in range(words)) + " (page 42)."
+
+
+LECTURE = "\n".join(
+    f"## Sub-topic {i}\n### Slide {i}:\n- **Key term** explained in ten words or fewer\n"
+    f"**Speaker Notes:**\n{answer_text()}\n**Check for Understanding:**\nRaise your hand if you think X..."
+    for i in range(1, 10)
+)
+
+
+def make_conversations():
+    textbook_id = str(ObjectId())
+    now = datetime.utcnow()
+    return [
+        {
+            "_id": ObjectId(),
+            "textbook_id": textbook_id,
+            "user_id": str(ObjectId()),
+            "question": f"What happens during stage {i} of photosynthesis?",
+            "answer": answer_text(),
+            "page_number": 42,
+            "timestamp": now - timedelta(minutes=i)
+        }
+        for i in range(50)
+    ]
+
+
+def old_conversations(conversations):
+    for conv in conversations:
+        conv["_id"] = str(conv["_id"])
+        conv["textbook_id"] = str(conv["textbook_id"])
+        if "timestamp" in conv:
+            conv["timestamp"] = conv["timestamp"].isoformat()
+    content = jsonable_encoder({"conversations": conversations})
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def new_conversations(conversations):
+    return BSONJSONResponse({"conversations": conversations}).body
+
+
+def old_lecture(payload):
+    content = jsonable_encoder(payload)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def new_lecture(payload):
+    return BSONJSONResponse(jsonable_encoder(payload)).body
+
+
+def timed(func, make_input):
+    inputs = [make_input() for _ in range(ITERATIONS)]
+    start = time.perf_counter()
+    for item in inputs:
+        body = func(item)
+    return (time.perf_counter() - start) / ITERATIONS, body
+
+
+def report(name, old, new, make_input):
+    old_time, old_body = timed(old, make_input)
+    new_time, new_body = timed(new, make_input)
+    print(f"\n{name}")
+    print(f"  Serialize (old): {old_time * 1000:.3f} ms, {len(old_body)} bytes")
+    print(f"  Serialize (new): {new_time * 1000:.3f} ms, {len(new_body)} bytes "
+          f"({(1 - new_time / old_time) * 100:.0f}% less CPU)")
+
+    start = time.perf_counter()
+    gz = gzip.compress(new_body, compresslevel=6)
+    gz_time = time.perf_counter() - start
+    print(f"  gzip level 6: {len(gz)} bytes ({len(gz) / len(new_body) * 100:.1f}% of raw), {gz_time * 1000:.2f} ms")
+    if brotli is not None:
+        for quality in (4, 6, 8):
+            start = time.perf_counter()
+            br = brotli.compress(new_body, quality=quality)
+            br_time = time.perf_counter() - start
+            print(f"  brotli q{quality}:    {len(br)} bytes ({len(br) / len(new_body) * 100:.1f}% of raw), {br_time * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    print("=" * 50)
+    print("Serialization Benchmark")
+    print("=" * 50)
+    print(f"orjson: {'yes' if orjson else 'no (stdlib json fallback)'}, brotli: {'yes' if brotli else 'no'}")
+
+    report("/conversations (50 documents)", old_conversations, new_conversations, make_conversations)
+    report(
+        "/generate-lecture",
+        old_lecture,
+        new_lecture,
+        lambda: {"lecture_content": LECTURE, "topic": "Photosynthesis", "chapter": None, "textbook_id": str(ObjectId())}
+    )
@@ -39,16 +39,29 @@ if client:
         textbooks_collection = db["textbooks"]
         conversations_collection = db["conversations"]
         users_collection = db["users"]
+        sessions_collection = db["sessions"]
+        ocr_cache_collection = db["ocr_cache"]
     except Exception as e:
         print(f"Error accessing database: {e}")
         db = None
         textbooks_collection = None
         conversations_collection = None
         users_collection = None
+        sessions_collection = None
+        ocr_cache_collection = None
 else:
     # Fallback to avoid errors
     db = None
     textbooks_collection = None
     conversations_collection = None
     users_collection = None
+    sessions_collection = None
+    ocr_cache_collection = None
 
+if sessions_collection is not None:
+    try:
+        # Sessions are looked up by token digest; Mongo drops them once expired
+        sessions_collection.create_index("token_hash", unique=True)
+        sessions_collection.create_index("expires_at", expireAfterSeconds=0)
+    except Exception as e:
+        print(f"Warning: Could not create session indexes: {e}")
@@ -0,0 +1,221 @@
+"""
+Ingest-time textbook enrichment.
+
+Builds the artifacts stored alongside each textbook so request handlers don't
+have to re-derive structure from raw text: a table of contents (from PDF
+bookmarks, falling back to detected headings), a short extractive summary per
+section and a keyword -> pages index.
+"""
+import math
+import re
+from collections import Counter
+from typing import List, Optional
+
+PAGE_MARKER = re.compile(r"\n--- Page (\d+) ---\n")
+WORD = re.compile(r"[a-z][a-z\-]{2,}")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+CHAPTER_HEADING = re.compile(r"^(chapter|unit|part|lesson|module)\s+(\d+|[ivxlc]+)\b[\s:.\-]*(.*)$", re.IGNORECASE)
+SECTION_HEADING = re.compile(r"^(\d{1,2})\.(\d{1,2})\s+([A-Z][^.]{2,80})$")
+
+STOPWORDS = set("""
+a about above after again against all also although among an and any are as at be because been before being
+below between both but by can could did do does doing down during each either etc even every few for from
+further had has have having he her here hers him his how however i if in into is it its itself just let
+many may might more most much must my neither no nor not now of off often on once only or other our ours
+out over own per rather same shall she should since so some such than that the their theirs them then
+there these they this those though through thus to too under until up upon us use used using very was we
+were what when where whether which while who whom whose why will with within without would yet you your
+figure table page chapter section example exercise exercises shown following
+""".split())
+
+MAX_HEADING_LINES = 5
+MAX_KEYWORDS = 2000
+MAX_PAGES_PER_KEYWORD = 20
+SUMMARY_SENTENCES = 3
+SUMMARY_MAX_CHARS = 600
+SUMMARY_MAX_PAGES = 20
+
+
+def split_pages(content: str) -> List[str]:
+    """Split stored textbook content back into per-page text (index 0 = page 1)"""
+    parts = PAGE_MARKER.split(content or "")
+    # parts = [preamble, "1", text1, "2", text2, ...]
+    pages = []
+    for i in range(1, len(parts) - 1, 2):
+        page_num = int(parts[i])
+        while len(pages) < page_num - 1:
+            pages.append("")
+        pages.append(parts[i + 1])
+    return pages
+
+
+def join_pages(pages: List[str]) -> str:
+    """Inverse of split_pages: the stored content format with page markers"""
+    return "".join(f"\n--- Page {page_num} ---\n{text}" for page_num, text in enumerate(pages, start=1))
+
+
+def tokenize(text: str) -> List[str]:
+    return [w for w in WORD.findall(text.lower()) if w not in STOPWORDS]
+
+
+def _bookmark_entries(reader) -> list:
+    """Flatten PDF bookmarks into (title, level, page) entries"""
+    try:
+        outline = reader.outline
+    except Exception:
+        return []
+
+    entries = []
+
+    def walk(items, level):
+        for item in items:
+            if isinstance(item, list):
+                walk(item, level + 1)
+                continue
+            try:
+                page = reader.get_destination_page_number(item) + 1
+            except Exception:
+                continue
+            title = str(getattr(item, "title", "") or "").strip()
+            if title and page > 0:
+                entries.append({"title": title, "level": level, "page": page})
+
+    walk(outline or [], 0)
+    return entries
+
+
+def _heading_entries(pages: List[str]) -> list:
+    """Detect chapter/section headings near the top of each page"""
+    entries = []
+    seen = set()
+    for page_num, text in enumerate(pages, start=1):
+        lines = [line.strip() for line in text.splitlines() if line.strip()][:MAX_HEADING_LINES]
+        for i, line in enumerate(lines):
+            match = CHAPTER_HEADING.match(line)
+            if match:
+                title = line
+                # "Chapter 3" alone is usually followed by the chapter name on the next line
+                if not match.group(3) and i + 1 < len(lines) and len(lines[i + 1]) <= 80:
+                    title = f"{line}: {lines[i + 1]}"
+                key = (0, match.group(1).lower(), match.group(2).lower())
+                level = 0
+            else:
+                match = SECTION_HEADING.match(line)
+                if not match:
+                    continue
+                title = line
+                key = (1, match.group(1), match.group(2))
+                level = 1
+            if key in seen:
+                continue
+            seen.add(key)
+            entries.append({"title": title, "level": level, "page": page_num})
+            break
+    return entries
+
+
+def _summarize(text: str) -> str:
+    """Pick the few sentences with the densest frequent vocabulary, in reading order"""
+    sentences = [s.strip() for s in SENTENCE_END.split(" ".join(text.split())) if 40 <= len(s.strip()) <= 400]
+    sentences = list(dict.fromkeys(sentences))
+    if not sentences:
+        return ""
+    freq = Counter(tokenize(text))
+    scored = []
+    for i, sentence in enumerate(sentences):
+        words = tokenize(sentence)
+        if words:
+            scored.append((sum(freq[w] for w in words) / len(words), i))
+    top = sorted(i for _, i in sorted(scored, reverse=True)[:SUMMARY_SENTENCES])
+    summary = " ".join(sentences[i] for i in top)
+    return summary[:SUMMARY_MAX_CHARS]
+
+
+def build_outline(pages: List[str], reader=None) -> list:
+    """
+    Table of contents with page ranges and a summary per entry.
+    Uses PDF bookmarks when present, otherwise detected headings.
+    """
+    entries = _bookmark_entries(reader) if reader is not None else []
+    source = "bookmarks"
+    if not entries:
+        entries = _heading_entries(pages)
+        source = "headings"
+
+    entries.sort(key=lambda e: e["page"])
+    page_count = len(pages)
+    outline = []
+    for i, entry in enumerate(entries):
+        # A section runs until the next entry at the same or a higher level
+        end_page = page_count
+        for later in entries[i + 1:]:
+            if later["level"] <= entry["level"]:
+                end_page = max(entry["page"], later["page"] - 1)
+                break
+        section_text = "\n".join(pages[entry["page"] - 1:min(end_page, entry["page"] - 1 + SUMMARY_MAX_PAGES)])
+        outline.append({
+            "title": entry["title"],
+            "level": entry["level"],
+            "start_page": entry["page"],
+            "end_page": end_page,
+            "summary": _summarize(section_text),
+            "source": source
+        })
+    return outline
+
+
+def build_keyword_index(pages: List[str]) -> dict:
+    """Map distinctive terms to the pages where they matter most (tf-idf ranked)"""
+    page_terms = [Counter(tokenize(text)) for text in pages]
+    doc_freq = Counter()
+    for terms in page_terms:
+        doc_freq.update(terms.keys())
+
+    page_count = max(len(pages), 1)
+    postings = {}
+    for page_num, terms in enumerate(page_terms, start=1):
+        for term, count in terms.items():
+            df = doc_freq[term]
+            # Skip terms on more than half the pages - they don't locate anything
+            if page_count > 4 and df > page_count / 2:
+                continue
+            weight = count * math.log(1 + page_count / df)
+            postings.setdefault(term, []).append((weight, page_num))
+
+    ranked_terms = sorted(postings, key=lambda t: max(w for w, _ in postings[t]), reverse=True)[:MAX_KEYWORDS]
+    index = {}
+    for term in ranked_terms:
+        best = sorted(postings[term], reverse=True)[:MAX_PAGES_PER_KEYWORD]
+        index[term] = sorted(page for _, page in best)
+    return index
+
+
+def enrich_textbook(content: str, reader=None) -> dict:
+    """Compute all ingest-time artifacts for a textbook"""
+    pages = split_pages(content)
+    return {
+        "outline": build_outline(pages, reader),
+        "keyword_index": build_keyword_index(pages)
+    }
+
+
+def find_section(outline: list, query: Optional[str]) -> Optional[dict]:
+    """Find the outline entry whose title best matches a chapter/topic string"""
+    if not outline or not query:
+        return None
+    query_lower = query.strip().lower()
+    query_terms = set(tokenize(query))
+    best, best_score = None, 0.0
+    for entry in outline:
+        title = entry["title"].lower()
+        if query_lower == title or (len(query_lower) > 3 and re.search(rf"\b{re.escape(query_lower)}\b", title)):
+            return entry
+        title_terms = set(tokenize(entry["title"]))
+        if not query_terms or not title_terms:
+            continue
+        score = len(query_terms & title_terms) / len(query_terms | title_terms)
+        if score > best_score:
+            best, best_score = entry, score
+    return best if best_score >= 0.5 else None
+
@@ -0,0 +1,206 @@
+"""
+Per-user search index over every page of a user's textbooks.
+
+Each user's library gets an in-memory BM25 inverted index, built lazily from the
+stored page text on first search and kept current as textbooks are uploaded or
+deleted. Only the most recently used libraries stay in memory, within a byte
+budget (LIBRARY_INDEX_BUDGET_MB).
+"""
+import math
+import os
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Iterable, List, Optional
+
+from enrichment import split_pages, tokenize
+
+MAX_CACHED_LIBRARIES = 200
+LIBRARY_INDEX_BUDGET_BYTES = int(os.getenv("LIBRARY_INDEX_BUDGET_MB", 256)) * 1024 * 1024
+# Page text for snippets plus postings and doc lengths cost a few times the raw text
+SIZE_OVERHEAD = 4
+SNIPPET_CHARS = 160
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class LibraryIndex:
+    """BM25 index whose documents are (textbook_id, page) pairs"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}      # term -> {(textbook_id, page): term frequency}
+        self.doc_lengths = {}   # (textbook_id, page) -> token count
+        self.books = {}         # textbook_id -> {"filename", "pages", "terms", "chars"}
+        self.total_length = 0
+        self.text_chars = 0
+
+    @property
+    def size_bytes(self) -> int:
+        return self.text_chars * SIZE_OVERHEAD
+
+    def add_textbook(self, textbook_id: str, filename: str, pages: List[str]):
+        with self.lock:
+            self._remove(textbook_id)
+            book_terms = set()
+            for page_num, text in enumerate(pages, start=1):
+                counts = Counter(tokenize(text))
+                if not counts:
+                    continue
+                doc = (textbook_id, page_num)
+                length = sum(counts.values())
+                self.doc_lengths[doc] = length
+                self.total_length += length
+                for term, count in counts.items():
+                    self.postings.setdefault(term, {})[doc] = count
+                book_terms.update(counts)
+            chars = sum(len(text) for text in pages)
+            self.books[textbook_id] = {"filename": filename, "pages": pages, "terms": book_terms, "chars": chars}
+            self.text_chars += chars
+
+    def remove_textbook(self, textbook_id: str):
+        with self.lock:
+            self._remove(textbook_id)
+
+    def _remove(self, textbook_id: str):
+        book = self.books.pop(textbook_id, None)
+        if not book:
+            return
+        self.text_chars -= book["chars"]
+        for term in book["terms"]:
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            for doc in [d for d in docs if d[0] == textbook_id]:
+                del docs[doc]
+            if not docs:
+                del self.postings[term]
+        for doc in [d for d in self.doc_lengths if d[0] == textbook_id]:
+            self.total_length -= self.doc_lengths.pop(doc)
+
+    def search(self, query: str, limit: int = 10, textbook_id: Optional[str] = None) -> List[dict]:
+        """Ranked page hits with a snippet around the first matching term"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self.lock:
+            doc_count = len(self.doc_lengths)
+            if not terms or not doc_count:
+                return []
+            avg_length = self.total_length / doc_count
+            scores = {}
+            for term in terms:
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc, tf in docs.items():
+                    if textbook_id and doc[0] != textbook_id:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc] / avg_length)
+                    scores[doc] = scores.get(doc, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+            top = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+            hits = []
+            for (book_id, page_num), score in top:
+                book = self.books[book_id]
+                hits.append({
+                    "textbook_id": book_id,
+                    "filename": book["filename"],
+                    "page": page_num,
+                    "score": round(score, 4),
+                    "snippet": _snippet(book["pages"][page_num - 1], terms)
+                })
+            return hits
+
+
+def _snippet(text: str, terms: Iterable[str]) -> str:
+    flat = " ".join(text.split())
+    lowered = flat.lower()
+    positions = [pos for pos in (lowered.find(term) for term in terms) if pos >= 0]
+    start = max(0, min(positions) - SNIPPET_CHARS // 3) if positions else 0
+    snippet = flat[start:start + SNIPPET_CHARS]
+    return ("..." if start > 0 else "") + snippet + ("..." if start + SNIPPET_CHARS < len(flat) else "")
+
+
+_libraries = OrderedDict()
+_libraries_lock = threading.Lock()
+# user_id -> uploads/deletes that arrived while that user's index was being built
+_pending_changes = {}
+
+
+def _evict_locked():
+    """Drop least recently used libraries until within the count and byte limits"""
+    while len(_libraries) > 1 and (
+        len(_libraries) > MAX_CACHED_LIBRARIES
+        or sum(index.size_bytes for index in _libraries.values()) > LIBRARY_INDEX_BUDGET_BYTES
+    ):
+        _libraries.popitem(last=False)
+
+
+def _apply_change(index: LibraryIndex, change: tuple):
+    if change[0] == "add":
+        _, textbook_id, filename, content = change
+        index.add_textbook(textbook_id, filename, split_pages(content))
+    else:
+        index.remove_textbook(change[1])
+
+
+def get_library_index(user_id: str, load_textbooks: Callable[[str], Iterable[dict]]) -> LibraryIndex:
+    """
+    Return the user's index, building it from `load_textbooks(user_id)`
+    (documents with _id, filename and content) if it isn't in memory.
+    Blocking - call it from a worker thread in async code.
+    """
+    with _libraries_lock:
+        index = _libraries.get(user_id)
+        if index is not None:
+            _libraries.move_to_end(user_id)
+            return index
+        _pending_changes.setdefault(user_id, [])
+
+    index = LibraryIndex()
+    for textbook in load_textbooks(user_id):
+        index.add_textbook(str(textbook["_id"]), textbook.get("filename", ""), split_pages(textbook.get("content", "")))
+
+    while True:
+        with _libraries_lock:
+            changes = _pending_changes.get(user_id)
+            if not changes:
+                _pending_changes.pop(user_id, None)
+                # Another request may have built it meanwhile; keep the first one
+                index = _libraries.setdefault(user_id, index)
+                _libraries.move_to_end(user_id)
+                _evict_locked()
+                return index
+            _pending_changes[user_id] = []
+        # Replay uploads/deletes the snapshot we built from may have missed (add and remove are idempotent)
+        for change in changes:
+            _apply_change(index, change)
+
+
+def _record_change(user_id: Optional[str], change: tuple):
+    with _libraries_lock:
+        index = _libraries.get(user_id)
+        if index is None:
+            if user_id in _pending_changes:
+                _pending_changes[user_id].append(change)
+            return
+    _apply_change(index, change)
+    with _libraries_lock:
+        _evict_locked()
+
+
+def index_textbook(user_id: Optional[str], textbook_id: str, filename: str, content: str):
+    """Add an uploaded textbook to its owner's index, if that index is loaded (or being built)"""
+    _record_change(user_id, ("add", textbook_id, filename, content))
+
+
+def unindex_textbook(user_id: Optional[str], textbook_id: str):
+    """Drop a deleted textbook from its owner's index, if that index is loaded (or being built)"""
+    _record_change(user_id, ("remove", textbook_id))
+
+
+def best_textbook(hits: List[dict]) -> Optional[str]:
+    """The textbook with the most total relevance among the hits"""
+    totals = Counter()
+    for hit in hits:
+        totals[hit["textbook_id"]] += hit["score"]
+    return totals.most_common(1)[0][0] if totals else None
@@ -0,0 +1,133 @@
+"""
+Request deadlines and client-disconnect cancellation.
+
+Every HTTP request runs as its own task. The task is cancelled when the client
+disconnects or the endpoint's deadline passes before the response is sent, so
+abandoned requests stop paying for model calls and never write their results.
+Once the response is sent, background tasks run on without a deadline.
+Draining on shutdown is the server's job (uvicorn --timeout-graceful-shutdown);
+when it gives up and cancels a request, the cancellation reaches the request
+task so its cleanup (e.g. marking a quiz job interrupted) still runs.
+"""
+import asyncio
+import json
+import os
+from collections import Counter
+from typing import Optional
+
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 60))
+
+# Endpoints that wait on the model (or parse whole PDFs) get longer than the default
+ENDPOINT_DEADLINES = {
+    "/ask-question": 90,
+    "/explain-answer": 90,
+    "/generate-lecture": 180,
+    "/upload-textbook": 300,
+}
+# e.g. REQUEST_DEADLINES="/generate-lecture=240,/ask-question=60"
+for override in filter(None, os.getenv("REQUEST_DEADLINES", "").split(",")):
+    path, _, seconds = override.partition("=")
+    ENDPOINT_DEADLINES[path.strip()] = float(seconds)
+
+
+def deadline_for(path: str) -> float:
+    return ENDPOINT_DEADLINES.get(path, REQUEST_DEADLINE_SECONDS)
+
+
+class RequestTracker:
+    """In-flight request tasks and what happened to them"""
+
+    def __init__(self):
+        self.tasks = set()
+        self.counters = Counter()
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.tasks), **self.counters}
+
+
+class RequestLifecycleMiddleware:
+    def __init__(self, app, tracker: Optional[RequestTracker] = None):
+        self.app = app
+        self.tracker = tracker or RequestTracker()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        body_read = asyncio.Event()
+        response_sent = asyncio.Event()
+        response_started = False
+
+        async def receive_tracked():
+            message = await receive()
+            if message["type"] == "http.request" and not message.get("more_body"):
+                body_read.set()
+            return message
+
+        async def send_tracked(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                response_sent.set()
+            await send(message)
+
+        async def client_gone():
+            # Only listen once the app has the whole body, so we never take its messages
+            await body_read.wait()
+            while not response_sent.is_set():
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+
+        task = asyncio.ensure_future(self.app(scope, receive_tracked, send_tracked))
+        self.tracker.tasks.add(task)
+        task.add_done_callback(self.tracker.tasks.discard)
+        watcher = asyncio.ensure_future(client_gone())
+        sent = asyncio.ensure_future(response_sent.wait())
+        deadline = deadline_for(scope["path"])
+        try:
+            done, _ = await asyncio.wait({task, watcher, sent}, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            watcher.cancel()
+            sent.cancel()
+
+        if task in done or response_sent.is_set():
+            # Response is out; let background tasks finish
+            try:
+                await task
+            except asyncio.CancelledError:
+                task.cancel()
+                raise
+            return
+
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            if not task.done():
+                raise
+
+        if watcher in done:
+            # Nobody is listening; nothing to send
+            self.tracker.counters["client_disconnects"] += 1
+            return
+
+        self.tracker.counters["deadline_exceeded"] += 1
+        print(f"Warning: {scope['method']} {scope['path']} exceeded its {deadline:.0f}s deadline")
+        if not response_started:
+            await _send_error(send, 504, f"Request took longer than {deadline:.0f} seconds, please try again")
+
+
+async def _send_error(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -1,19 +1,32 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, BackgroundTasks, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, FileResponse, Response
 from dotenv import load_dotenv
 import os
 from google import genai
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List
 import PyPDF2
 import io
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 from bson import ObjectId
 import base64
-import hashlib
-import secrets
-from database import textbooks_collection, conversations_collection, users_collection, users_collection
+import asyncio
+import hmac
+from database import textbooks_collection, conversations_collection, users_collection, sessions_collection, ocr_cache_collection
+from security import hash_password, verify_password, verify_unknown_user, needs_rehash, create_session, get_session, delete_session, shutdown_hash_pool
+from enrichment import enrich_textbook, find_section, split_pages, join_pages
+from prompting import build_prompt
+from library_index import get_library_index, index_textbook, unindex_textbook, best_textbook
+from ocr import ocr_available, find_blank_pages, single_page_pdf, page_hash, ocr_page, OCR_WORKERS, shutdown_ocr_pool
+from residency import ResidentSet, HOT_THRESHOLD
+from storage import StorageManager, QuotaExceeded, check_quota, user_storage_used, reconcile, USER_QUOTA_BYTES, RECONCILE_INTERVAL_SECONDS
+from responses import BSONJSONResponse, CompressionMiddleware
+from singleflight import SingleFlight, coalesce_key
+from lifecycle import RequestLifecycleMiddleware, RequestTracker
+from quizzes import QUIZ_CONCURRENCY, QUIZ_KINDS, quiz_chapters, source_hash, render_quiz_prompt, parse_quiz_items
 
 # Load env variables
 load_dotenv()
@@ -21,7 +34,162 @@ load_dotenv()
 # Create Gemini client
 client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
 
-app = FastAPI()
+# Identical model calls already in flight are shared instead of repeated
+model_calls = SingleFlight()
+MODEL_CALL_TIMEOUT_SECONDS = float(os.getenv("MODEL_CALL_TIMEOUT_SECONDS", 120))
+
+async def generate_text(prompt):
+    """Run a built prompt through Gemini without blocking the event loop"""
+    try:
+        response = await asyncio.wait_for(
+            client.aio.models.generate_content(
+                model=prompt.model,
+                contents=prompt.text
+            ),
+            MODEL_CALL_TIMEOUT_SECONDS
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="The AI model took too long to respond, please try again")
+    return response.text
+
+# In-flight requests, and how many were cut short by disconnects or deadlines
+request_tracker = RequestTracker()
+
+# PDF storage (UPLOADS_DIR, quotas, cold storage)
+storage = StorageManager()
+
+async def storage_reconcile_loop():
+    """Periodically remove orphaned files/records and move idle textbooks to cold storage"""
+    while True:
+        try:
+            if textbooks_collection is not None:
+                stats = await run_in_threadpool(reconcile, storage, textbooks_collection, remove_textbook_record)
+                if any(stats.values()):
+                    print(f"Storage reconcile: {stats}")
+        except Exception as e:
+            print(f"Warning: Storage reconcile failed: {e}")
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+
+# Hot textbooks kept in memory (page text, token counts, retriever)
+resident_set = ResidentSet()
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PRELOAD_TEXTBOOKS = [t.strip() for t in os.getenv("PRELOAD_TEXTBOOKS", "").split(",") if t.strip()]
+WARM_START_TEXTBOOKS = int(os.getenv("RESIDENT_WARM_START", 10))
+ACCESS_FLUSH_SECONDS = 60
+
+def preload_textbook(textbook_id, pinned=False):
+    """
+    Load a textbook into the resident set regardless of how hot it is.
+    Pins may evict unpinned books; unpinned loads only use free space.
+    """
+    try:
+        textbook = textbooks_collection.find_one({"_id": ObjectId(textbook_id)})
+    except:
+        textbook = textbooks_collection.find_one({"_id": textbook_id})
+    if not textbook:
+        raise HTTPException(status_code=404, detail=f"Textbook {textbook_id} not found")
+    return resident_set.admit(textbook, textbook_pages(textbook), pinned=pinned, force=True)
+
+def warm_start():
+    """Preload pinned textbooks, then the ones most used over the last week"""
+    if textbooks_collection is None:
+        return
+    for textbook_id in PRELOAD_TEXTBOOKS:
+        try:
+            preload_textbook(textbook_id, pinned=True)
+        except Exception as e:
+            print(f"Warning: Could not preload textbook {textbook_id}: {e}")
+    try:
+        recent = textbooks_collection.find(
+            {"last_accessed_at": {"$gte": datetime.utcnow() - timedelta(days=7)}}, {"_id": 1}
+        ).sort("access_count", -1).limit(WARM_START_TEXTBOOKS)
+        # Most used first; these only fill free space, so a later book never pushes out a hotter one
+        for doc in recent:
+            try:
+                preload_textbook(doc["_id"])
+            except HTTPException:
+                continue
+    except Exception as e:
+        print(f"Warning: Could not warm start resident textbooks: {e}")
+
+async def flush_access_counts():
+    """Persist access counts so the next process knows which textbooks are hot"""
+    counts = resident_set.take_pending_counts()
+    try:
+        for textbook_id, count in counts.items():
+            await run_in_threadpool(
+                textbooks_collection.update_one,
+                {"_id": ObjectId(textbook_id)},
+                {"$inc": {"access_count": count}, "$set": {"last_accessed_at": datetime.utcnow()}}
+            )
+    except Exception as e:
+        print(f"Warning: Could not save textbook access counts: {e}")
+
+async def access_flush_loop():
+    while True:
+        await asyncio.sleep(ACCESS_FLUSH_SECONDS)
+        await flush_access_counts()
+
+def record_textbook_access(textbook_id):
+    """
+    Count one request against a textbook's residency score. Called by the handler
+    for every request, not inside coalesced model calls, so 40 students asking the
+    same question count as 40 accesses.
+    """
+    if textbook_id and ObjectId.is_valid(str(textbook_id)):
+        resident_set.record_access(str(textbook_id))
+
+async def load_textbook_for_prompt(textbook_id):
+    """
+    Textbook metadata and per-page text for the model endpoints.
+    Hot textbooks come from the resident set; a textbook that just became hot
+    is loaded into it in the background. Returns (textbook, pages, resident).
+    Access is counted by the caller (record_textbook_access).
+    """
+    resident = resident_set.get(str(textbook_id))
+    if resident:
+        return resident.textbook, resident.pages, resident
+    
+    try:
+        textbook = textbooks_collection.find_one({"_id": ObjectId(textbook_id)})
+    except:
+        textbook = textbooks_collection.find_one({"_id": textbook_id})
+    
+    if not textbook:
+        raise HTTPException(status_code=404, detail="Textbook not found")
+    
+    pages = textbook_pages(textbook)
+    # Only finished textbooks; OCR and enrichment still change them
+    if resident_set.score(str(textbook["_id"])) >= HOT_THRESHOLD and (textbook.get("ingest") or {}).get("status", "ready") == "ready":
+        asyncio.get_running_loop().run_in_executor(None, resident_set.admit, textbook, pages)
+    return textbook, pages, None
+
+def check_admin(token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API disabled - set ADMIN_TOKEN")
+    if not hmac.compare_digest((token or "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load hot textbooks before taking traffic so the first questions aren't the slow ones
+    await run_in_threadpool(warm_start)
+    background = [
+        asyncio.create_task(storage_reconcile_loop()),
+        asyncio.create_task(access_flush_loop()),
+        asyncio.create_task(ingest_recovery_loop())
+    ]
+    yield
+    # By now the server has drained (or cancelled) in-flight requests
+    for task in background + list(resumed_ocr):
+        task.cancel()
+    await asyncio.gather(*resumed_ocr, return_exceptions=True)
+    if textbooks_collection is not None:
+        await flush_access_counts()
+    shutdown_hash_pool()
+    shutdown_ocr_pool()
+
+app = FastAPI(default_response_class=BSONJSONResponse, lifespan=lifespan)
 
 # Helper function to check database connection
 def check_database():
@@ -31,6 +199,306 @@ def check_database():
             detail="Database not connected. Please check your MONGODB_URL in .env file"
         )
 
+# Large per-textbook artifacts that list/detail endpoints shouldn't send
+HEAVY_TEXTBOOK_FIELDS = {"content": 0, "keyword_index": 0, "outline": 0}
+
+# Failed enrichment is retried with exponential backoff, up to a limit
+ENRICH_MAX_ATTEMPTS = 3
+ENRICH_RETRY_BACKOFF = timedelta(minutes=5)
+# An ingest step untouched for this long was abandoned (e.g. by a restart) and is picked up again
+INGEST_STALE_AFTER = timedelta(minutes=15)
+INGEST_RECOVERY_SECONDS = 300
+
+def run_enrichment(textbook_id):
+    """
+    Build the outline, section summaries and keyword index for a textbook.
+    Runs as a background task after upload so the upload request returns quickly.
+    """
+    attempts = 0
+    try:
+        textbook = textbooks_collection.find_one({"_id": textbook_id})
+        if not textbook:
+            return
+        attempts = (textbook.get("ingest") or {}).get("attempts", 0)
+        pdf_bytes = storage.read(textbook)
+        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes)) if pdf_bytes else None
+        artifacts = enrich_textbook(textbook.get("content", ""), reader)
+        textbooks_collection.update_one(
+            {"_id": textbook_id},
+            {
+                "$set": {**artifacts, "ingest.status": "ready", "ingest.enriched_at": datetime.utcnow()},
+                "$unset": {"ingest.error": "", "ingest.retry_at": ""}
+            }
+        )
+        resident_set.evict(str(textbook_id))
+    except Exception as e:
+        print(f"Warning: Could not enrich textbook {textbook_id}: {e}")
+        textbooks_collection.update_one(
+            {"_id": textbook_id},
+            {
+                "$set": {
+                    "ingest.status": "failed",
+                    "ingest.error": str(e),
+                    "ingest.retry_at": datetime.utcnow() + ENRICH_RETRY_BACKOFF * 2 ** attempts
+                },
+                "$inc": {"ingest.attempts": 1}
+            }
+        )
+
+def claim_enrichment(textbook_id):
+    """
+    Atomically take a textbook for (re-)enrichment if it's due: never enriched,
+    failed and past its backoff, or abandoned mid-enrichment. False otherwise.
+    """
+    now = datetime.utcnow()
+    claimed = textbooks_collection.find_one_and_update(
+        {"_id": textbook_id, "$or": [
+            {"ingest": {"$exists": False}, "outline": {"$exists": False}},
+            {"ingest.status": "failed", "ingest.attempts": {"$not": {"$gte": ENRICH_MAX_ATTEMPTS}}, "ingest.retry_at": {"$not": {"$gt": now}}},
+            {"ingest.status": "enriching", "ingest.started_at": {"$not": {"$gte": now - INGEST_STALE_AFTER}}}
+        ]},
+        {"$set": {"ingest.status": "enriching", "ingest.started_at": now}},
+        {"_id": 1}
+    )
+    return claimed is not None
+
+def recover_ingests():
+    """Re-run enrichment that failed (within the retry limit) or was abandoned by a restart"""
+    now = datetime.utcnow()
+    due = textbooks_collection.find({"$or": [
+        {"ingest.status": "failed", "ingest.attempts": {"$not": {"$gte": ENRICH_MAX_ATTEMPTS}}, "ingest.retry_at": {"$not": {"$gt": now}}},
+        {"ingest.status": "enriching", "ingest.started_at": {"$not": {"$gte": now - INGEST_STALE_AFTER}}}
+    ]}, {"_id": 1})
+    for doc in list(due):
+        if claim_enrichment(doc["_id"]):
+            print(f"Resuming enrichment of textbook {doc['_id']}")
+            run_enrichment(doc["_id"])
+
+async def ingest_recovery_loop():
+    while True:
+        try:
+            if textbooks_collection is not None:
+                for textbook_id, blank_pages in await run_in_threadpool(claim_ocr_resumes):
+                    print(f"Resuming OCR of textbook {textbook_id} ({len(blank_pages)} pages)")
+                    task = asyncio.create_task(run_ocr(textbook_id, blank_pages))
+                    resumed_ocr.add(task)
+                    task.add_done_callback(resumed_ocr.discard)
+                await run_in_threadpool(recover_ingests)
+        except Exception as e:
+            print(f"Warning: Ingest recovery failed: {e}")
+        await asyncio.sleep(INGEST_RECOVERY_SECONDS)
+
+async def run_ocr(textbook_id, blank_pages):
+    """
+    OCR the pages that had no text layer, then enrich the textbook.
+    Progress is reported through the textbook's ingest status. PDF parsing,
+    page extraction and database calls run in worker threads so a big scan
+    doesn't stall request handling.
+    """
+    try:
+        textbook = await run_in_threadpool(
+            textbooks_collection.find_one, {"_id": textbook_id}, {"content": 1, "pdf_path": 1, "filename": 1, "user_id": 1}
+        )
+        if not textbook:
+            return
+        pdf_bytes = await run_in_threadpool(storage.read, textbook)
+        reader = await run_in_threadpool(PyPDF2.PdfReader, io.BytesIO(pdf_bytes))
+        pages = split_pages(textbook.get("content", ""))
+        
+        # Keep just enough pages in flight to keep the OCR workers busy
+        window = asyncio.Semaphore(OCR_WORKERS * 2)
+        # PdfReader isn't thread-safe; extract one page at a time
+        extract_lock = asyncio.Lock()
+        done = 0
+        
+        async def ocr_one(page_num):
+            nonlocal done
+            async with window:
+                async with extract_lock:
+                    page_pdf = await run_in_threadpool(single_page_pdf, reader, page_num)
+                key = page_hash(page_pdf)
+                cached = await run_in_threadpool(ocr_cache_collection.find_one, {"_id": key})
+                if cached:
+                    text = cached["text"]
+                else:
+                    text = await ocr_page(page_pdf)
+                    await run_in_threadpool(
+                        ocr_cache_collection.update_one,
+                        {"_id": key},
+                        {"$set": {"text": text, "created_at": datetime.utcnow()}},
+                        upsert=True
+                    )
+            pages[page_num - 1] = text
+            done += 1
+            await run_in_threadpool(
+                textbooks_collection.update_one,
+                {"_id": textbook_id},
+                {"$set": {"ingest.ocr_pages_done": done, "ingest.heartbeat_at": datetime.utcnow()}}
+            )
+        
+        await asyncio.gather(*[ocr_one(page_num) for page_num in blank_pages])
+        
+        content = join_pages(pages)
+        await run_in_threadpool(
+            textbooks_collection.update_one,
+            {"_id": textbook_id},
+            {"$set": {"content": content, "ingest.status": "enriching", "ingest.started_at": datetime.utcnow()}}
+        )
+        await run_in_threadpool(index_textbook, textbook.get("user_id"), str(textbook_id), textbook.get("filename", ""), content)
+    except asyncio.CancelledError:
+        # Shutting down; the recovery loop resumes it (already-OCR'd pages come from the cache)
+        textbooks_collection.update_one({"_id": textbook_id}, {"$set": {"ingest.status": "interrupted"}})
+        raise
+    except Exception as e:
+        # Keep whatever text we have; enrichment still runs on it
+        print(f"Warning: OCR failed for textbook {textbook_id}: {e}")
+        await run_in_threadpool(textbooks_collection.update_one, {"_id": textbook_id}, {"$set": {"ingest.ocr_error": str(e)}})
+    await run_in_threadpool(run_enrichment, textbook_id)
+
+def claim_ocr_resumes():
+    """
+    Take over OCR that was interrupted by a shutdown, or whose process died
+    mid-scan. Returns (textbook_id, pages still blank) for each claimed textbook.
+    """
+    now = datetime.utcnow()
+    claimed = []
+    while True:
+        doc = textbooks_collection.find_one_and_update(
+            {"$or": [
+                {"ingest.status": "interrupted"},
+                {"ingest.status": "ocr", "ingest.heartbeat_at": {"$not": {"$gte": now - INGEST_STALE_AFTER}}}
+            ]},
+            {"$set": {"ingest.status": "ocr", "ingest.heartbeat_at": now}},
+            {"content": 1}
+        )
+        if not doc:
+            return claimed
+        claimed.append((doc["_id"], find_blank_pages(split_pages(doc.get("content", "")))))
+
+# OCR runs resumed by the recovery loop (upload-time OCR runs as a request background task)
+resumed_ocr = set()
+
+# Chapters being generated at once, across all quiz jobs
+quiz_slots = asyncio.Semaphore(QUIZ_CONCURRENCY)
+
+async def run_quiz_job(job_id, textbook, pages, resident, chapters, kind, items_per_chapter, user_id, prune):
+    """
+    Build the quiz/flashcard set for each chapter, reusing stored sets whose
+    pages haven't changed. Progress is reported on the job document.
+    """
+    textbook_id = str(textbook["_id"])
+    conversations_collection.update_one({"_id": job_id}, {"$set": {"status": "running", "started_at": datetime.utcnow()}})
+    try:
+        stored = {
+            (doc.get("chapter"), doc.get("start_page")): doc
+            for doc in conversations_collection.find({"type": kind, "textbook_id": textbook_id}, {"chapter": 1, "start_page": 1, "source_hash": 1})
+        }
+        
+        async def build_set(chapter):
+            digest = source_hash(pages, chapter, kind, items_per_chapter)
+            existing = stored.get((chapter["title"], chapter["start_page"]))
+            if existing and existing.get("source_hash") == digest:
+                conversations_collection.update_one({"_id": job_id}, {"$inc": {"chapters_done": 1, "chapters_reused": 1}})
+                return
+            try:
+                async with quiz_slots:
+                    prompt = build_prompt(
+                        lambda limited_content: render_quiz_prompt(kind, chapter, items_per_chapter, limited_content),
+                        pages,
+                        endpoint=f"generate-{kind}",
+                        priority_pages=range(chapter["start_page"], chapter["end_page"] + 1),
+                        include_unranked=False,
+                        output_tokens=4096,
+                        ranked_pages=[],
+                        page_tokens=resident.page_tokens if resident else None
+                    )
+                    key = coalesce_key(f"generate-{kind}", textbook_id, digest)
+                    reply = await model_calls.do(key, lambda: generate_text(prompt))
+                items = parse_quiz_items(reply, chapter)
+                conversations_collection.update_one(
+                    {"type": kind, "textbook_id": textbook_id, "chapter": chapter["title"], "start_page": chapter["start_page"]},
+                    {"$set": {
+                        "user_id": user_id,
+                        "end_page": chapter["end_page"],
+                        "items": items,
+                        "context_pages": prompt.pages,
+                        "source_hash": digest,
+                        "timestamp": datetime.utcnow()
+                    }},
+                    upsert=True
+                )
+                conversations_collection.update_one({"_id": job_id}, {"$inc": {"chapters_done": 1, "chapters_generated": 1}})
+            except Exception as e:
+                print(f"Warning: Could not generate {kind} for '{chapter['title']}' of textbook {textbook_id}: {e}")
+                conversations_collection.update_one(
+                    {"_id": job_id},
+                    {"$inc": {"chapters_done": 1}, "$push": {"failed_chapters": {"chapter": chapter["title"], "error": str(e)}}}
+                )
+        
+        await asyncio.gather(*[build_set(chapter) for chapter in chapters])
+        
+        if prune:
+            # Chapters that no longer exist in the outline
+            current = {(chapter["title"], chapter["start_page"]) for chapter in chapters}
+            stale = [doc["_id"] for key, doc in stored.items() if key not in current]
+            if stale:
+                conversations_collection.delete_many({"_id": {"$in": stale}})
+        
+        conversations_collection.update_one({"_id": job_id}, {"$set": {"status": "done", "finished_at": datetime.utcnow()}})
+    except asyncio.CancelledError:
+        # Shutting down; finished chapters are stored, so re-running the job picks up where it stopped
+        conversations_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "interrupted", "finished_at": datetime.utcnow()}}
+        )
+        raise
+    except Exception as e:
+        print(f"Warning: Quiz job {job_id} failed: {e}")
+        conversations_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.utcnow()}}
+        )
+
+def remove_textbook_record(textbook):
+    """Delete a textbook's record, its conversations and its search index entries"""
+    textbook_id = str(textbook["_id"])
+    textbooks_collection.delete_one({"_id": textbook["_id"]})
+    unindex_textbook(textbook.get("user_id"), textbook_id)
+    resident_set.evict(textbook_id)
+    try:
+        conversations_collection.delete_many({"textbook_id": textbook_id})
+    except Exception as e:
+        print(f"Warning: Could not delete conversations: {e}")
+
+def textbook_pages(textbook):
+    """Per-page text, refusing textbooks with no text at all so we don't pay for an empty prompt"""
+    pages = split_pages(textbook.get("content", ""))
+    if not any(page.strip() for page in pages):
+        if (textbook.get("ingest") or {}).get("status") in ("ocr", "interrupted"):
+            raise HTTPException(status_code=409, detail="Textbook is still being scanned (OCR), please try again shortly")
+        raise HTTPException(status_code=409, detail="Textbook has no extractable text")
+    return pages
+
+def extract_cited_pages(answer, page_count):
+    """All page numbers an answer cites, e.g. "page 5", "pages 12-14", "(p. 7)" """
+    import re
+    cited = []
+    for start, end in re.findall(r'\b(?:pages?|pp?\.)\s*(\d+)(?:\s*(?:-|–|to)\s*(\d+))?', answer, re.IGNORECASE):
+        first = int(start)
+        last = int(end) if end else first
+        for page in range(first, min(last, first + 10) + 1):
+            if 1 <= page <= page_count and page not in cited:
+                cited.append(page)
+    return cited
+
+def load_library(user_id):
+    """Textbooks (with page text) used to build a user's search index"""
+    return textbooks_collection.find({"user_id": user_id}, {"filename": 1, "content": 1})
+
+# Per-endpoint deadlines and cancellation when the client goes away
+# (added first so CORS headers still apply to its 504s)
+app.add_middleware(RequestLifecycleMiddleware, tracker=request_tracker)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -40,15 +508,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress large JSON payloads (lecture plans, conversation history)
+app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MIN_BYTES", 1024)))
+
 # Request models
 class QuestionRequest(BaseModel):
     textbook_id: str
     question: str
 
 class ExplainRequest(BaseModel):
-    textbook_id: str
-    answer: str
+    textbook_id: Optional[str] = None
+    answer: Optional[str] = None
     question: Optional[str] = None
+    conversation_id: Optional[str] = None  # Explain a stored answer using only its pages
 
 class LectureRequest(BaseModel):
     textbook_id: str
@@ -84,10 +556,11 @@ def check_gemini():
         return {"status": f"Error: {str(e)}"}
 
 @app.post("/upload-textbook")
-async def upload_textbook(file: UploadFile = File(...), user_id: Optional[str] = Query(None)):
+async def upload_textbook(background_tasks: BackgroundTasks, file: UploadFile = File(...), user_id: Optional[str] = Query(None)):
     """
     Upload a PDF textbook and extract its text content.
-    Stores the textbook metadata and content in MongoDB.
+    Stores the textbook metadata and content in MongoDB, then builds the
+    outline and keyword index in the background.
     """
     check_database()
     try:
@@ -97,17 +570,19 @@ async def upload_textbook(file: UploadFile = File(...), user_id: Optional[str] =
         # Read PDF file
         contents = await file.read()
         pdf_file = io.BytesIO(contents)
+        check_quota(textbooks_collection, user_id, len(contents))
         
         # Extract text from PDF
         pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text_content = ""
+        pages = [page.extract_text() or "" for page in pdf_reader.pages]
+        text_content = join_pages(pages)
         
-        for page_num, page in enumerate(pdf_reader.pages):
-            text_content += f"\n--- Page {page_num + 1} ---\n"
-            text_content += page.extract_text()
+        # Scanned pages have no text layer - they go to the OCR lane
+        blank_pages = find_blank_pages(pages) if ocr_available() else []
+        ingest = {"status": "ocr", "ocr_pages_total": len(blank_pages), "ocr_pages_done": 0, "heartbeat_at": datetime.utcnow()} if blank_pages else {"status": "enriching", "started_at": datetime.utcnow()}
         
-        # Store PDF file locally
-        os.makedirs("uploads", exist_ok=True)
+        # Write the PDF to a temp file first; it only gets its final name once the record exists
+        tmp_path = storage.write_temp(contents)
         
         # Store in MongoDB first to get ID
         textbook_doc = {
@@ -115,33 +590,54 @@ async def upload_textbook(file: UploadFile = File(...), user_id: Optional[str] =
             "uploaded_at": datetime.utcnow(),
             "content": text_content,
             "page_count": len(pdf_reader.pages),
-            "user_id": user_id  # Link textbook to user
+            "file_size": len(contents),
+            "user_id": user_id,  # Link textbook to user
+            "ingest": ingest
         }
         
-        result = textbooks_collection.insert_one(textbook_doc)
+        try:
+            result = textbooks_collection.insert_one(textbook_doc)
+            # Parallel uploads can all pass the first check; now that this one counts, check again
+            # (a race can reject both uploads, but never lets them through over the quota together)
+            check_quota(textbooks_collection, user_id, 0)
+            storage.commit(tmp_path, str(result.inserted_id))
+        except Exception:
+            storage.discard(tmp_path)
+            if textbook_doc.get("_id") is not None:
+                textbooks_collection.delete_one({"_id": textbook_doc["_id"]})
+            raise
         textbook_id = str(result.inserted_id)
         
-        # Save PDF file with textbook_id as filename
-        pdf_path = f"uploads/{textbook_id}.pdf"
-        with open(pdf_path, "wb") as f:
-            f.write(contents)
-        
-        # Update with PDF path
-        textbooks_collection.update_one(
-            {"_id": result.inserted_id},
-            {"$set": {"pdf_path": pdf_path}}
-        )
+        if blank_pages:
+            background_tasks.add_task(run_ocr, result.inserted_id, blank_pages)
+        else:
+            background_tasks.add_task(run_enrichment, result.inserted_id)
+        await run_in_threadpool(index_textbook, user_id, textbook_id, file.filename, text_content)
         
         return {
             "message": "Textbook uploaded successfully",
             "textbook_id": textbook_id,
             "filename": file.filename,
-            "page_count": len(pdf_reader.pages)
+            "page_count": len(pdf_reader.pages),
+            "ingest": ingest
         }
     
+    except QuotaExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading textbook: {str(e)}")
 
+@app.get("/storage/usage")
+def get_storage_usage(user_id: str = Query(...)):
+    """Bytes of PDF storage a user is using, and their quota (0 = unlimited)"""
+    check_database()
+    try:
+        return {"user_id": user_id, "used_bytes": user_storage_used(textbooks_collection, user_id), "quota_bytes": USER_QUOTA_BYTES}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching storage usage: {str(e)}")
+
 @app.get("/textbooks")
 def get_textbooks(user_id: Optional[str] = None):
     """Get list of uploaded textbooks for a specific user"""
@@ -149,10 +645,8 @@ def get_textbooks(user_id: Optional[str] = None):
     try:
         # Filter by user_id if provided
         query = {"user_id": user_id} if user_id else {}
-        textbooks = list(textbooks_collection.find(query, {"content": 0}))  # Exclude content for list view
-        for textbook in textbooks:
-            textbook["_id"] = str(textbook["_id"])
-        return {"textbooks": textbooks}
+        textbooks = list(textbooks_collection.find(query, HEAVY_TEXTBOOK_FIELDS))  # Exclude content for list view
+        return BSONJSONResponse({"textbooks": textbooks})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching textbooks: {str(e)}")
 
@@ -170,25 +664,14 @@ def delete_textbook(textbook_id: str):
         if not textbook:
             raise HTTPException(status_code=404, detail="Textbook not found")
         
-        # Delete PDF file from filesystem
-        pdf_path = textbook.get("pdf_path", f"uploads/{textbook_id}.pdf")
-        if os.path.exists(pdf_path):
-            try:
-                os.remove(pdf_path)
-            except Exception as e:
-                print(f"Warning: Could not delete PDF file: {e}")
-        
-        # Delete from MongoDB
+        # Delete PDF file from filesystem (anything left behind is removed by the storage reconciler)
         try:
-            textbooks_collection.delete_one({"_id": ObjectId(textbook_id)})
-        except:
-            textbooks_collection.delete_one({"_id": textbook_id})
-        
-        # Also delete related conversations
-        try:
-            conversations_collection.delete_many({"textbook_id": textbook_id})
+            storage.delete(textbook)
         except Exception as e:
-            print(f"Warning: Could not delete conversations: {e}")
+            print(f"Warning: Could not delete PDF file, leaving it to the reconciler: {e}")
+        
+        # Delete from MongoDB, along with related conversations
+        remove_textbook_record(textbook)
         
         return {
             "message": "Textbook deleted successfully",
@@ -200,32 +683,49 @@ def delete_textbook(textbook_id: str):
         raise HTTPException(status_code=500, detail=f"Error deleting textbook: {str(e)}")
 
 class QuestionRequest(BaseModel):
-    textbook_id: str
+    textbook_id: Optional[str] = None  # Omit to route the question to the best-matching book in the user's library
     question: str
     user_id: Optional[str] = None
 
+@app.get("/search")
+def search_library(user_id: str = Query(...), q: str = Query(...), limit: int = Query(10, ge=1, le=50)):
+    """Search every page of a user's textbooks; returns ranked (textbook, page, snippet) hits"""
+    check_database()
+    try:
+        index = get_library_index(user_id, load_library)
+        return {"query": q, "results": index.search(q, limit)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching library: {str(e)}")
+
 @app.post("/ask-question")
 async def ask_question(request: QuestionRequest):
     """
     Ask a question about the uploaded textbook.
     Uses Gemini AI to find and return relevant answers from the textbook.
+    Without a textbook_id, the user's library is searched and only the
+    best-matching book's matching pages are sent.
     """
     check_database()
     try:
-        # Get textbook from database
-        try:
-            textbook = textbooks_collection.find_one({"_id": ObjectId(request.textbook_id)})
-        except:
-            textbook = textbooks_collection.find_one({"_id": request.textbook_id})
-        
-        if not textbook:
-            raise HTTPException(status_code=404, detail="Textbook not found")
+        hit_pages = []
+        if not request.textbook_id:
+            if not request.user_id:
+                raise HTTPException(status_code=400, detail="Provide textbook_id, or user_id to search your library")
+            # Building a cold index reads and tokenizes every textbook - keep it off the event loop
+            index = await run_in_threadpool(get_library_index, request.user_id, load_library)
+            hits = await run_in_threadpool(index.search, request.question, 20)
+            request.textbook_id = best_textbook(hits)
+            if not request.textbook_id:
+                raise HTTPException(status_code=404, detail="No textbook in your library matches this question")
+            hit_pages = [hit["page"] for hit in hits if hit["textbook_id"] == request.textbook_id]
         
-        textbook_content = textbook.get("content", "")
-        
-        # Create prompt for Gemini (limit content to avoid token limits)
-        limited_content = textbook_content[:50000]
-        prompt = f"""You are an educational AI assistant helping students and teachers with textbook content.
+        async def answer_question():
+            # Get textbook (from memory if it's hot)
+            textbook, pages, resident = await load_textbook_for_prompt(request.textbook_id)
+            
+            # Create prompt for Gemini, packing the most relevant pages into the token budget
+            def render(limited_content):
+                return f"""You are an educational AI assistant helping students and teachers with textbook content.
 
 Textbook Content:
 {limited_content}
@@ -237,14 +737,24 @@ If the answer is not found in the textbook, please state that clearly.
 Include the page number or chapter reference if possible.
 
 Answer:"""
+            
+            prompt = build_prompt(
+                render, pages,
+                endpoint="ask-question",
+                query=request.question,
+                keyword_index=textbook.get("keyword_index"),
+                priority_pages=hit_pages,
+                include_unranked=not hit_pages,
+                ranked_pages=resident.rank_pages(request.question) if resident else None,
+                page_tokens=resident.page_tokens if resident else None
+            )
+            return textbook, prompt, await generate_text(prompt)
         
-        # Get response from Gemini
-        response = client.models.generate_content(
-            model="models/gemini-flash-latest",
-            contents=prompt
-        )
-        
-        answer = response.text
+        # The same question asked at the same time (e.g. a whole class) is answered once;
+        # each asker still counts as an access and gets their own conversation record
+        record_textbook_access(request.textbook_id)
+        key = coalesce_key("ask-question", request.textbook_id, "library" if hit_pages else "textbook", request.question)
+        textbook, prompt, answer = await model_calls.do(key, answer_question)
         
         # Try to extract page number from answer - multiple patterns
         page_number = None
@@ -267,23 +777,28 @@ Answer:"""
                 except:
                     continue
         
-        # Store conversation in database
+        # Store conversation in database, with the pages behind the answer for follow-ups
         conversation_doc = {
             "textbook_id": request.textbook_id,
             "user_id": request.user_id,  # Link conversation to user
             "question": request.question,
             "answer": answer,
             "page_number": page_number,
+            "cited_pages": extract_cited_pages(answer, textbook.get("page_count", 0)),
+            "context_pages": prompt.pages,
             "timestamp": datetime.utcnow()
         }
-        conversations_collection.insert_one(conversation_doc)
+        result = conversations_collection.insert_one(conversation_doc)
         
         return {
             "answer": answer,
             "textbook_id": request.textbook_id,
-            "page_number": page_number
+            "page_number": page_number,
+            "conversation_id": str(result.inserted_id)
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
 
@@ -292,30 +807,52 @@ async def explain_answer(request: ExplainRequest):
     """
     Explain an answer in simple words using the textbook as reference.
     Useful for students who don't understand the initial answer.
+    With a conversation_id, only the pages behind the original answer are sent
+    and the explanation is cached on the conversation.
     """
     check_database()
     try:
-        # Get textbook from database
-        try:
-            textbook = textbooks_collection.find_one({"_id": ObjectId(request.textbook_id)})
-        except:
-            textbook = textbooks_collection.find_one({"_id": request.textbook_id})
-        
-        if not textbook:
-            raise HTTPException(status_code=404, detail="Textbook not found")
+        conversation = None
+        if request.conversation_id:
+            try:
+                conversation = conversations_collection.find_one({"_id": ObjectId(request.conversation_id)})
+            except:
+                conversation = None
+            if not conversation:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+            if not conversation.get("answer"):
+                # Lectures, quiz sets and quiz jobs share the collection but have no answer to explain
+                raise HTTPException(status_code=400, detail="Conversation is not a question and answer")
+            
+            # Repeat clicks on "Explain in simple words" are served from the stored explanation
+            if conversation.get("explanation"):
+                return {
+                    "explanation": conversation["explanation"],
+                    "original_answer": conversation["answer"],
+                    "conversation_id": request.conversation_id,
+                    "cached": True
+                }
         
-        textbook_content = textbook.get("content", "")
+        textbook_id = conversation["textbook_id"] if conversation else request.textbook_id
+        answer = conversation["answer"] if conversation else request.answer
+        question = conversation.get("question") if conversation else request.question
+        if not textbook_id or not answer:
+            raise HTTPException(status_code=400, detail="Provide conversation_id, or textbook_id and answer")
         
-        # Create prompt for Gemini to explain in simple words (limit content to avoid token limits)
-        limited_content = textbook_content[:50000]
-        prompt = f"""You are an educational AI assistant helping students understand complex textbook content.
+        async def explain():
+            # Get textbook (from memory if it's hot)
+            textbook, pages, resident = await load_textbook_for_prompt(textbook_id)
+            
+            # Create prompt for Gemini to explain in simple words, within the token budget
+            def render(limited_content):
+                return f"""You are an educational AI assistant helping students understand complex textbook content.
 
 Textbook Content (for reference):
 {limited_content}
 
-Original Question: {request.question or "Not provided"}
+Original Question: {question or "Not provided"}
 
-Original Answer: {request.answer}
+Original Answer: {answer}
 
 Please explain the above answer in very simple, easy-to-understand words. 
 Break down complex concepts into simpler terms.
@@ -324,20 +861,59 @@ Make it suitable for students who are struggling to understand the material.
 Keep the explanation clear and concise.
 
 Simple Explanation:"""
+            
+            source_pages = []
+            if conversation:
+                # Only the pages the answer cites, or failing that the pages it was generated from
+                source_pages = conversation.get("cited_pages") or conversation.get("context_pages") or []
+                if not source_pages and conversation.get("page_number"):
+                    source_pages = [conversation["page_number"]]
+            if source_pages:
+                prompt = build_prompt(
+                    render, pages,
+                    endpoint="explain-answer",
+                    priority_pages=source_pages,
+                    include_unranked=False,
+                    output_tokens=1024,
+                    ranked_pages=[],
+                    page_tokens=resident.page_tokens if resident else None
+                )
+            else:
+                # No conversation, or one stored before pages were recorded - rank pages by the Q&A text
+                query = f"{question or ''} {answer}"
+                prompt = build_prompt(
+                    render, pages,
+                    endpoint="explain-answer",
+                    query=query,
+                    keyword_index=textbook.get("keyword_index"),
+                    output_tokens=1024,
+                    ranked_pages=resident.rank_pages(query) if resident else None,
+                    page_tokens=resident.page_tokens if resident else None
+                )
+            return await generate_text(prompt)
         
-        # Get response from Gemini
-        response = client.models.generate_content(
-            model="models/gemini-flash-latest",
-            contents=prompt
-        )
+        record_textbook_access(textbook_id)
+        if conversation:
+            key = coalesce_key("explain-answer", textbook_id, request.conversation_id)
+        else:
+            key = coalesce_key("explain-answer", textbook_id, question, answer)
+        explanation = await model_calls.do(key, explain)
         
-        explanation = response.text
+        if conversation:
+            conversations_collection.update_one(
+                {"_id": conversation["_id"]},
+                {"$set": {"explanation": explanation, "explained_at": datetime.utcnow()}}
+            )
         
         return {
             "explanation": explanation,
-            "original_answer": request.answer
+            "original_answer": answer,
+            "conversation_id": request.conversation_id,
+            "cached": False
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error explaining answer: {str(e)}")
 
@@ -349,21 +925,17 @@ async def generate_lecture(request: LectureRequest):
     """
     check_database()
     try:
-        # Get textbook from database
-        try:
-            textbook = textbooks_collection.find_one({"_id": ObjectId(request.textbook_id)})
-        except:
-            textbook = textbooks_collection.find_one({"_id": request.textbook_id})
-        
-        if not textbook:
-            raise HTTPException(status_code=404, detail="Textbook not found")
-        
-        textbook_content = textbook.get("content", "")
-        
-        # Create comprehensive prompt for lecture generation
-        limited_content = textbook_content[:50000]
-        
-        prompt = f"""### ROLE
+        async def lecture():
+            # Get textbook (from memory if it's hot)
+            textbook, pages, resident = await load_textbook_for_prompt(request.textbook_id)
+            
+            # Prefer the matching chapter's pages when the outline has one
+            section = find_section(textbook.get("outline"), request.chapter or request.topic)
+            section_pages = range(section["start_page"], section["end_page"] + 1) if section else ()
+            
+            # Create comprehensive prompt for lecture generation
+            def render(limited_content):
+                return f"""### ROLE
 You are an expert University Professor and Curriculum Designer with 20 years of experience. Your goal is to convert raw textbook content into a structured, high-energy 45-minute lecture plan.
 
 ### INPUT
@@ -432,14 +1004,24 @@ Structure your response as follows:
 Professional, engaging, organized. Use bolding for key terms.
 
 Now generate the lecture plan for the topic: {request.topic}"""
+            
+            query = f"{request.topic} {request.chapter or ''}"
+            prompt = build_prompt(
+                render, pages,
+                endpoint="generate-lecture",
+                query=query,
+                keyword_index=textbook.get("keyword_index"),
+                priority_pages=section_pages,
+                include_unranked=section is None,
+                output_tokens=8192,
+                ranked_pages=resident.rank_pages(query) if resident else None,
+                page_tokens=resident.page_tokens if resident else None
+            )
+            return await generate_text(prompt)
         
-        # Get response from Gemini
-        response = client.models.generate_content(
-            model="models/gemini-flash-latest",
-            contents=prompt
-        )
-        
-        lecture_content = response.text
+        record_textbook_access(request.textbook_id)
+        key = coalesce_key("generate-lecture", request.textbook_id, request.topic, request.chapter)
+        lecture_content = await model_calls.do(key, lecture)
         
         # Store lecture in database
         lecture_doc = {
@@ -460,9 +1042,106 @@ Now generate the lecture plan for the topic: {request.topic}"""
             "textbook_id": request.textbook_id
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating lecture: {str(e)}")
 
+class QuizRequest(BaseModel):
+    textbook_id: str
+    user_id: Optional[str] = None
+    kind: str = "quiz"  # "quiz" (multiple choice) or "flashcards"
+    chapters: Optional[List[str]] = None  # Chapter titles; omit for every chapter
+    items_per_chapter: int = 10
+
+@app.post("/generate-quiz")
+async def generate_quiz(request: QuizRequest, background_tasks: BackgroundTasks):
+    """
+    Start a job that builds a quiz or flashcard set for each chapter of a textbook.
+    Sets are stored and reused; re-running only regenerates chapters whose pages changed.
+    Poll /quiz-jobs/{job_id} for progress and read the sets from /quizzes/{textbook_id}.
+    """
+    check_database()
+    try:
+        if request.kind not in QUIZ_KINDS:
+            raise HTTPException(status_code=400, detail=f"kind must be one of: {', '.join(QUIZ_KINDS)}")
+        if not 1 <= request.items_per_chapter <= 50:
+            raise HTTPException(status_code=400, detail="items_per_chapter must be between 1 and 50")
+        
+        record_textbook_access(request.textbook_id)
+        textbook, pages, resident = await load_textbook_for_prompt(request.textbook_id)
+        if (textbook.get("ingest") or {}).get("status") in ("ocr", "interrupted", "enriching"):
+            raise HTTPException(status_code=409, detail="Textbook is still being processed, please try again shortly")
+        
+        chapters = quiz_chapters(textbook.get("outline"), len(pages))
+        if request.chapters:
+            selected = []
+            for name in request.chapters:
+                chapter = find_section(chapters, name)
+                if not chapter:
+                    raise HTTPException(status_code=404, detail=f"Chapter not found: {name}")
+                if chapter not in selected:
+                    selected.append(chapter)
+            chapters = selected
+        
+        job = {
+            "type": "quiz_job",
+            "kind": request.kind,
+            "textbook_id": request.textbook_id,
+            "user_id": request.user_id,
+            "status": "queued",
+            "chapters": [chapter["title"] for chapter in chapters],
+            "chapters_total": len(chapters),
+            "chapters_done": 0,
+            "chapters_generated": 0,
+            "chapters_reused": 0,
+            "failed_chapters": [],
+            "timestamp": datetime.utcnow()
+        }
+        job_id = conversations_collection.insert_one(job).inserted_id
+        background_tasks.add_task(
+            run_quiz_job, job_id, textbook, pages, resident, chapters,
+            request.kind, request.items_per_chapter, request.user_id, not request.chapters
+        )
+        
+        return {
+            "job_id": str(job_id),
+            "status": "queued",
+            "kind": request.kind,
+            "chapters": job["chapters"]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error starting quiz job: {str(e)}")
+
+@app.get("/quiz-jobs/{job_id}")
+def get_quiz_job(job_id: str):
+    """Status and progress of a quiz/flashcard job"""
+    check_database()
+    try:
+        job = conversations_collection.find_one({"_id": ObjectId(job_id), "type": "quiz_job"})
+    except:
+        job = None
+    if not job:
+        raise HTTPException(status_code=404, detail="Quiz job not found")
+    return BSONJSONResponse(job)
+
+@app.get("/quizzes/{textbook_id}")
+def get_quizzes(textbook_id: str, kind: str = Query("quiz")):
+    """Stored quiz or flashcard sets for a textbook, in chapter order"""
+    check_database()
+    if kind not in QUIZ_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of: {', '.join(QUIZ_KINDS)}")
+    try:
+        sets = list(conversations_collection.find(
+            {"type": kind, "textbook_id": textbook_id},
+            {"source_hash": 0}
+        ).sort("start_page", 1))
+        return BSONJSONResponse({"textbook_id": textbook_id, "kind": kind, "sets": sets})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching quizzes: {str(e)}")
+
 @app.get("/conversations/{textbook_id}")
 def get_conversations(textbook_id: str, user_id: Optional[str] = None):
     """Get conversation history for a specific textbook and user"""
@@ -475,6 +1154,8 @@ def get_conversations(textbook_id: str, user_id: Optional[str] = None):
         
         # Filter by textbook_id and user_id if provided
         query = {"textbook_id": str(textbook_id)}
+        # Quiz sets and jobs are listed by /quizzes, not in the chat history
+        query["type"] = {"$nin": ["quiz_job", *QUIZ_KINDS]}
         if user_id:
             query["user_id"] = user_id
         
@@ -482,13 +1163,7 @@ def get_conversations(textbook_id: str, user_id: Optional[str] = None):
             query
         ).sort("timestamp", -1).limit(50))
         
-        for conv in conversations:
-            conv["_id"] = str(conv["_id"])
-            conv["textbook_id"] = str(conv["textbook_id"])
-            if "timestamp" in conv:
-                conv["timestamp"] = conv["timestamp"].isoformat()
-        
-        return {"conversations": conversations}
+        return BSONJSONResponse({"conversations": conversations})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching conversations: {str(e)}")
 
@@ -497,42 +1172,69 @@ def get_textbook(textbook_id: str):
     """Get a specific textbook with its content"""
     check_database()
     try:
+        # Don't return full content or the large derived artifacts for this endpoint
         try:
-            textbook = textbooks_collection.find_one({"_id": ObjectId(textbook_id)})
+            textbook = textbooks_collection.find_one({"_id": ObjectId(textbook_id)}, HEAVY_TEXTBOOK_FIELDS)
         except:
-            textbook = textbooks_collection.find_one({"_id": textbook_id})
+            textbook = textbooks_collection.find_one({"_id": textbook_id}, HEAVY_TEXTBOOK_FIELDS)
         
         if not textbook:
             raise HTTPException(status_code=404, detail="Textbook not found")
         
-        textbook["_id"] = str(textbook["_id"])
-        # Don't return full content for this endpoint
-        textbook.pop("content", None)
-        return textbook
+        return BSONJSONResponse(textbook)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching textbook: {str(e)}")
 
+@app.get("/textbook/{textbook_id}/outline")
+def get_textbook_outline(textbook_id: str):
+    """Get the table of contents (with section summaries) built at ingest"""
+    check_database()
+    try:
+        projection = {"outline": 1, "ingest": 1}
+        try:
+            textbook = textbooks_collection.find_one({"_id": ObjectId(textbook_id)}, projection)
+        except:
+            textbook = textbooks_collection.find_one({"_id": textbook_id}, projection)
+        
+        if not textbook:
+            raise HTTPException(status_code=404, detail="Textbook not found")
+        
+        # Textbooks uploaded before enrichment existed (or whose retry is due) get their artifacts built now
+        if "outline" not in textbook and claim_enrichment(textbook["_id"]):
+            run_enrichment(textbook["_id"])
+            textbook = textbooks_collection.find_one({"_id": textbook["_id"]}, projection)
+        ingest = textbook.get("ingest") or {}
+        
+        return {
+            "textbook_id": textbook_id,
+            "ingest_status": ingest.get("status", "ready"),
+            "outline": textbook.get("outline", [])
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching outline: {str(e)}")
+
 @app.get("/textbook/{textbook_id}/pdf")
 def get_textbook_pdf(textbook_id: str):
     """Serve the PDF file for a textbook - displays inline in browser"""
     check_database()
     try:
         try:
-            textbook = textbooks_collection.find_one({"_id": ObjectId(textbook_id)})
+            textbook = textbooks_collection.find_one({"_id": ObjectId(textbook_id)}, HEAVY_TEXTBOOK_FIELDS)
         except:
-            textbook = textbooks_collection.find_one({"_id": textbook_id})
+            textbook = textbooks_collection.find_one({"_id": textbook_id}, HEAVY_TEXTBOOK_FIELDS)
         
         if not textbook:
             raise HTTPException(status_code=404, detail="Textbook not found")
         
-        pdf_path = textbook.get("pdf_path", f"uploads/{textbook_id}.pdf")
-        
-        if not os.path.exists(pdf_path):
+        # Read PDF file (restored from cold storage if it was moved there)
+        pdf_content = storage.read(textbook)
+        if pdf_content is None:
             raise HTTPException(status_code=404, detail="PDF file not found")
         
-        # Read PDF file
-        with open(pdf_path, "rb") as f:
-            pdf_content = f.read()
+        # Opening a textbook keeps it out of cold storage
+        textbooks_collection.update_one({"_id": textbook["_id"]}, {"$set": {"last_opened_at": datetime.utcnow()}})
         
         # Return PDF with headers to display inline, not download
         return Response(
@@ -548,23 +1250,68 @@ def get_textbook_pdf(textbook_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error serving PDF: {str(e)}")
 
-# Helper function to hash password
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+# Admin endpoints
+class PreloadRequest(BaseModel):
+    textbook_ids: List[str]
+    pin: bool = True
+
+@app.get("/admin/residency")
+def get_residency(x_admin_token: Optional[str] = Header(None)):
+    """Resident (in-memory) textbooks, their size, pin state and heat"""
+    check_admin(x_admin_token)
+    return resident_set.stats()
+
+@app.post("/admin/residency/preload")
+def preload_residency(request: PreloadRequest, x_admin_token: Optional[str] = Header(None)):
+    """Load (and by default pin) textbooks ahead of a known peak"""
+    check_admin(x_admin_token)
+    check_database()
+    loaded, skipped = [], []
+    for textbook_id in request.textbook_ids:
+        resident = preload_textbook(textbook_id, pinned=request.pin)
+        (loaded if resident else skipped).append(textbook_id)
+    return {"loaded": loaded, "skipped_over_budget": skipped, **resident_set.stats()}
+
+@app.delete("/admin/residency/{textbook_id}/pin")
+def unpin_textbook(textbook_id: str, x_admin_token: Optional[str] = Header(None)):
+    """Let a pinned textbook be evicted again"""
+    check_admin(x_admin_token)
+    if not resident_set.unpin(textbook_id):
+        raise HTTPException(status_code=404, detail="Textbook is not resident")
+    return {"textbook_id": textbook_id, "pinned": False}
+
+@app.delete("/admin/residency/{textbook_id}")
+def evict_textbook(textbook_id: str, x_admin_token: Optional[str] = Header(None)):
+    """Drop a textbook from memory"""
+    check_admin(x_admin_token)
+    resident_set.evict(textbook_id)
+    return {"textbook_id": textbook_id, "resident": False}
+
+@app.get("/admin/requests")
+def get_request_stats(x_admin_token: Optional[str] = Header(None)):
+    """In-flight requests, and how many were cut short by disconnects or deadlines"""
+    check_admin(x_admin_token)
+    return request_tracker.stats()
+
+@app.get("/admin/coalescing")
+def get_coalescing(x_admin_token: Optional[str] = Header(None)):
+    """Model calls in flight and how many requests shared an identical in-flight call"""
+    check_admin(x_admin_token)
+    return model_calls.stats()
 
 # Authentication endpoints
 @app.post("/register")
-def register(request: RegisterRequest):
+async def register(request: RegisterRequest):
     check_database()
     
     try:
         # Check if user already exists
-        existing_user = users_collection.find_one({"email": request.email})
+        existing_user = await run_in_threadpool(users_collection.find_one, {"email": request.email})
         if existing_user:
             raise HTTPException(status_code=400, detail="Email already registered")
         
-        # Hash password
-        hashed_password = hash_password(request.password)
+        # Hash password (runs in the capped hashing pool, off the event loop)
+        hashed_password = await hash_password(request.password)
         
         # Create user document
         user_doc = {
@@ -575,11 +1322,11 @@ def register(request: RegisterRequest):
         }
         
         # Insert user
-        result = users_collection.insert_one(user_doc)
+        result = await run_in_threadpool(users_collection.insert_one, user_doc)
         user_id = str(result.inserted_id)
         
-        # Generate simple token (in production, use JWT)
-        token = secrets.token_urlsafe(32)
+        # Start a session for the new user
+        token = await run_in_threadpool(create_session, sessions_collection, user_id)
         
         return {
             "success": True,
@@ -594,27 +1341,37 @@ def register(request: RegisterRequest):
         raise HTTPException(status_code=500, detail=f"Registration error: {str(e)}")
 
 @app.post("/login")
-def login(request: LoginRequest):
+async def login(request: LoginRequest):
     check_database()
     
     try:
         # Find user by email
-        user = users_collection.find_one({"email": request.email})
+        # Database calls go through the threadpool: this handler is async, so a
+        # blocking call here would stall every other request during a login storm
+        user = await run_in_threadpool(users_collection.find_one, {"email": request.email})
         if not user:
+            # Same hashing cost as a wrong password, so response time doesn't reveal which emails exist
+            await verify_unknown_user(request.password)
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
-        # Hash provided password and compare
-        hashed_password = hash_password(request.password)
-        if user["password"] != hashed_password:
+        # Verify provided password against the stored hash
+        if not await verify_password(request.password, user["password"]):
             raise HTTPException(status_code=401, detail="Invalid email or password")
         
-        # Generate token
-        token = secrets.token_urlsafe(32)
+        # Upgrade legacy SHA-256 (or outdated cost) hashes now that we have the plaintext
+        if needs_rehash(user["password"]):
+            new_hash = await hash_password(request.password)
+            await run_in_threadpool(
+                users_collection.update_one, {"_id": user["_id"]}, {"$set": {"password": new_hash}}
+            )
+        
+        user_id = str(user["_id"])
+        token = await run_in_threadpool(create_session, sessions_collection, user_id)
         
         return {
             "success": True,
             "message": "Login successful",
-            "user_id": str(user["_id"]),
+            "user_id": user_id,
             "token": token,
             "name": user["name"]
         }
@@ -625,9 +1382,16 @@ def login(request: LoginRequest):
 
 @app.get("/check-auth")
 def check_auth(token: str = Query(...)):
-    """Check if token is valid (simplified - in production use proper JWT validation)"""
+    """Check if token belongs to a live session"""
     check_database()
-    # For now, just return success if token exists
-    # In production, validate token against stored sessions
-    return {"authenticated": True}
+    session = get_session(sessions_collection, token)
+    if not session:
+        raise HTTPException(status_code=401, detail="Invalid or expired session")
+    return {"authenticated": True, "user_id": session["user_id"]}
 
+@app.post("/logout")
+def logout(token: str = Query(...)):
+    """End the session for this token"""
+    check_database()
+    delete_session(sessions_collection, token)
+    return {"success": True}
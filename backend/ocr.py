@@ -0,0 +1,88 @@
+"""
+OCR fallback for scanned pages.
+
+Pages without a text layer are rendered and run through Tesseract in a
+separate, small process pool (low priority, single-threaded workers) so OCR
+can't starve uploads or request handling. Results are cached by a hash of the
+page itself, so re-uploads of the same scan are free.
+Needs the optional `pytesseract` and `pdf2image` packages plus the tesseract
+and poppler binaries; without them scanned pages are left empty.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import io
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import PyPDF2
+
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", 1))
+OCR_DPI = int(os.getenv("OCR_DPI", 200))
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+OCR_NICE = int(os.getenv("OCR_NICE", 10))
+
+# Pages with less extracted text than this are treated as having no text layer
+MIN_TEXT_CHARS = 20
+
+_pool = None
+
+
+def ocr_available() -> bool:
+    return (
+        importlib.util.find_spec("pytesseract") is not None
+        and importlib.util.find_spec("pdf2image") is not None
+        and shutil.which("tesseract") is not None
+        and shutil.which("pdftoppm") is not None
+    )
+
+
+def find_blank_pages(pages: List[str]) -> List[int]:
+    """Page numbers (1-based) whose extracted text is empty or nearly so"""
+    return [num for num, text in enumerate(pages, start=1) if len(text.strip()) < MIN_TEXT_CHARS]
+
+
+def single_page_pdf(reader, page_num: int) -> bytes:
+    """A standalone one-page PDF - what the worker renders, and what the cache key hashes"""
+    writer = PyPDF2.PdfWriter()
+    writer.add_page(reader.pages[page_num - 1])
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def page_hash(page_pdf: bytes) -> str:
+    return hashlib.sha256(page_pdf).hexdigest()
+
+
+def _init_worker():
+    # Stay behind request handling for CPU, and keep tesseract to one thread per worker
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    try:
+        os.nice(OCR_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+def _ocr_page(page_pdf: bytes) -> str:
+    from pdf2image import convert_from_bytes
+    import pytesseract
+
+    images = convert_from_bytes(page_pdf, dpi=OCR_DPI, thread_count=1)
+    return "\n".join(pytesseract.image_to_string(image, lang=OCR_LANG) for image in images)
+
+
+async def ocr_page(page_pdf: bytes) -> str:
+    """OCR one page in the bounded OCR process pool"""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=_init_worker)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool, _ocr_page, page_pdf)
+
+
+def shutdown_ocr_pool():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
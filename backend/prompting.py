@@ -0,0 +1,207 @@
+"""
+Token-budgeted prompt assembly shared by the model endpoints.
+
+Textbook context is packed into a per-model token budget as whole pages, in
+priority order: explicitly requested pages first (e.g. a chapter's range), then
+pages ranked by relevance to the query, then the rest in reading order. Room is
+reserved for the model's output, and each prompt's size is logged.
+"""
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, List, Optional
+
+from enrichment import tokenize
+
+DEFAULT_MODEL = "models/gemini-flash-latest"
+
+# input_budget caps what we spend per request; context_window is the hard model limit
+MODEL_LIMITS = {
+    "models/gemini-flash-latest": {"context_window": 1_000_000, "input_budget": 32_000},
+    "models/gemini-pro-latest": {"context_window": 2_000_000, "input_budget": 200_000},
+}
+DEFAULT_INPUT_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", MODEL_LIMITS[DEFAULT_MODEL]["input_budget"]))
+
+# When the relevant pages don't fit the default budget, switch to this model (if set).
+# Models not listed above need LARGE_CONTEXT_TOKEN_BUDGET (and optionally LARGE_CONTEXT_WINDOW).
+LARGE_CONTEXT_MODEL = os.getenv("LARGE_CONTEXT_MODEL")
+if LARGE_CONTEXT_MODEL and os.getenv("LARGE_CONTEXT_TOKEN_BUDGET"):
+    large_budget = int(os.getenv("LARGE_CONTEXT_TOKEN_BUDGET"))
+    MODEL_LIMITS[LARGE_CONTEXT_MODEL] = {
+        "context_window": int(os.getenv("LARGE_CONTEXT_WINDOW", MODEL_LIMITS.get(LARGE_CONTEXT_MODEL, {}).get("context_window", large_budget))),
+        "input_budget": large_budget,
+    }
+if LARGE_CONTEXT_MODEL and LARGE_CONTEXT_MODEL not in MODEL_LIMITS:
+    print(f"Warning: LARGE_CONTEXT_MODEL {LARGE_CONTEXT_MODEL} has no known token budget - "
+          f"set LARGE_CONTEXT_TOKEN_BUDGET; not escalating")
+    LARGE_CONTEXT_MODEL = None
+
+# Escalation looks at the priority pages plus this many of the best-ranked pages,
+# not every page that shares a word with the query
+ESCALATION_RANKED_PAGES = int(os.getenv("ESCALATION_RANKED_PAGES", 20))
+
+# Once this many pages in a row don't fit the remaining budget, stop looking
+MAX_SKIPPED_PAGES = 20
+
+TRUNCATION_MARK = "\n[...]"
+
+TOKEN_PIECE = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Local approximation of the model tokenizer: one token per punctuation mark,
+    and roughly one per four characters of each word. Errs slightly high.
+    """
+    return sum(math.ceil(len(piece) / 4) for piece in TOKEN_PIECE.findall(text))
+
+
+def input_budget(model: str) -> int:
+    if model == DEFAULT_MODEL:
+        return DEFAULT_INPUT_BUDGET
+    return MODEL_LIMITS.get(model, MODEL_LIMITS[DEFAULT_MODEL])["input_budget"]
+
+
+def format_page(page_num: int, text: str) -> str:
+    return f"\n--- Page {page_num} ---\n{text}"
+
+
+@dataclass
+class BuiltPrompt:
+    text: str
+    model: str
+    tokens: int
+    budget: int
+    pages: List[int] = field(default_factory=list)
+
+
+def rank_pages(pages: List[str], query: Optional[str], keyword_index: Optional[dict] = None) -> List[int]:
+    """Page numbers with any query-term match, most relevant first"""
+    terms = set(tokenize(query or ""))
+    if not terms:
+        return []
+
+    page_count = max(len(pages), 1)
+    lowered = None
+    scores = {}
+    for term in terms:
+        matches = (keyword_index or {}).get(term)
+        if matches is None:
+            # Not a distinctive indexed term - fall back to scanning the page text
+            if lowered is None:
+                lowered = [text.lower() for text in pages]
+            matches = [num for num, text in enumerate(lowered, start=1) if term in text]
+        if not matches:
+            continue
+        idf = math.log(1 + page_count / len(matches))
+        for page_num in matches:
+            scores[page_num] = scores.get(page_num, 0.0) + idf
+
+    return sorted(scores, key=lambda num: (-scores[num], num))
+
+
+def _fit_page(page_num: int, text: str, remaining: int):
+    """Cut an oversized page at a paragraph, line or word break so it fits the remaining budget"""
+    cut = len(text)
+    while cut > 0:
+        # Shrink proportionally to the overshoot, then back off to a natural break
+        tokens = count_tokens(format_page(page_num, text[:cut] + TRUNCATION_MARK))
+        if tokens <= remaining:
+            break
+        cut = int(cut * remaining / tokens * 0.95)
+        for separator in ("\n\n", "\n", " "):
+            boundary = text.rfind(separator, 0, cut)
+            if boundary > cut // 2:
+                cut = boundary
+                break
+    if cut <= 0:
+        return None, 0
+    return format_page(page_num, text[:cut] + TRUNCATION_MARK), tokens
+
+
+def build_prompt(
+    render: Callable[[str], str],
+    pages: List[str],
+    *,
+    endpoint: str,
+    query: Optional[str] = None,
+    keyword_index: Optional[dict] = None,
+    priority_pages: Iterable[int] = (),
+    include_unranked: bool = True,
+    output_tokens: int = 2048,
+    model: str = DEFAULT_MODEL,
+    ranked_pages: Optional[List[int]] = None,
+    page_tokens: Optional[List[int]] = None,
+) -> BuiltPrompt:
+    """
+    Fill `render(context)` with as many whole textbook pages as the model's budget allows.
+
+    `pages` is per-page text (index 0 = page 1). Pages are chosen from
+    `priority_pages`, then by relevance to `query`, then (if `include_unranked`)
+    in reading order; the chosen pages are emitted in page order with page markers.
+    Callers holding a textbook in memory can pass their own `ranked_pages` and
+    precomputed per-page `page_tokens` to skip that work.
+    """
+    page_count = len(pages)
+    ranked = ranked_pages if ranked_pages is not None else rank_pages(pages, query, keyword_index)
+    priority = [num for num in dict.fromkeys(priority_pages) if 1 <= num <= page_count]
+    preferred = list(priority)
+    for page_num in ranked:
+        if 1 <= page_num <= page_count and page_num not in preferred:
+            preferred.append(page_num)
+    order = list(preferred)
+    if include_unranked:
+        wanted = set(preferred)
+        order += [num for num in range(1, page_count + 1) if num not in wanted]
+
+    fixed_tokens = count_tokens(render(""))
+    token_counts = {}
+
+    def tokens_for(page_num):
+        if page_tokens is not None:
+            return page_tokens[page_num - 1]
+        if page_num not in token_counts:
+            token_counts[page_num] = count_tokens(format_page(page_num, pages[page_num - 1]))
+        return token_counts[page_num]
+
+    # Escalate to the large-context model only when the pages we actually want don't fit:
+    # the requested pages and the top few ranked ones. Every page sharing a word with the
+    # query would overflow the default budget for almost any question on a long book.
+    must_have = preferred[:len(priority) + ESCALATION_RANKED_PAGES]
+    preferred_tokens = sum(tokens_for(num) for num in must_have)
+    if (LARGE_CONTEXT_MODEL and model == DEFAULT_MODEL
+            and input_budget(LARGE_CONTEXT_MODEL) > input_budget(model)
+            and fixed_tokens + preferred_tokens + output_tokens > input_budget(model)):
+        model = LARGE_CONTEXT_MODEL
+
+    context_window = MODEL_LIMITS.get(model, MODEL_LIMITS[DEFAULT_MODEL])["context_window"]
+    budget = min(input_budget(model), context_window - output_tokens)
+    remaining = budget - fixed_tokens
+
+    blocks = {}
+    misses = 0
+    for page_num in order:
+        # Stop once the budget is spent, or once pages have stopped fitting
+        if remaining <= 0 or misses >= MAX_SKIPPED_PAGES:
+            break
+        tokens = tokens_for(page_num)
+        if tokens <= remaining:
+            blocks[page_num] = format_page(page_num, pages[page_num - 1])
+        elif not blocks:
+            # The first choice alone is too big - keep as much of it as fits
+            block, tokens = _fit_page(page_num, pages[page_num - 1], remaining)
+            if block is None:
+                continue
+            blocks[page_num] = block
+        else:
+            misses += 1
+            continue
+        remaining -= tokens
+
+    selected = sorted(blocks)
+    text = render("".join(blocks[num] for num in selected))
+    tokens = budget - remaining
+    print(f"[prompt] endpoint={endpoint} model={model} tokens~{tokens}/{budget} "
+          f"pages={len(selected)}/{page_count} output_reserved={output_tokens}")
+    return BuiltPrompt(text=text, model=model, tokens=tokens, budget=budget, pages=selected)
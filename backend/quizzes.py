@@ -0,0 +1,103 @@
+"""
+Per-chapter quiz and flashcard sets.
+
+A set is generated once per chapter from that chapter's pages and stored with a
+hash of those pages, so re-running a job only regenerates chapters whose text
+changed (e.g. after OCR filled in scanned pages). Chapters come from the
+textbook outline, or fixed page ranges when it has none.
+"""
+import hashlib
+import json
+import os
+import re
+from typing import List, Optional
+
+QUIZ_CONCURRENCY = int(os.getenv("QUIZ_CONCURRENCY", 4))
+QUIZ_KINDS = ("quiz", "flashcards")
+# Chapter size when a textbook has no outline
+PAGES_PER_CHUNK = 15
+# Bump when the prompt or item format changes so stored sets are rebuilt
+PROMPT_VERSION = 1
+
+CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def quiz_chapters(outline: Optional[list], page_count: int) -> List[dict]:
+    """The units a set is built for: top-level outline entries, or page chunks"""
+    entries = outline or []
+    levels = sorted({entry["level"] for entry in entries})
+    chapters = []
+    for level in levels:
+        chapters = [entry for entry in entries if entry["level"] == level]
+        # A single top-level entry is usually the book title - go one level down
+        if len(chapters) > 1:
+            break
+    if chapters:
+        return [
+            {"title": entry["title"], "start_page": entry["start_page"], "end_page": entry["end_page"]}
+            for entry in chapters
+        ]
+    return [
+        {"title": f"Pages {start}-{min(start + PAGES_PER_CHUNK - 1, page_count)}",
+         "start_page": start, "end_page": min(start + PAGES_PER_CHUNK - 1, page_count)}
+        for start in range(1, page_count + 1, PAGES_PER_CHUNK)
+    ]
+
+
+def source_hash(pages: List[str], chapter: dict, kind: str, item_count: int) -> str:
+    """Changes whenever the chapter's page text or the requested set changes"""
+    digest = hashlib.sha256(f"{PROMPT_VERSION}|{kind}|{item_count}".encode())
+    for page_num in range(chapter["start_page"], chapter["end_page"] + 1):
+        digest.update(b"\x00")
+        digest.update(pages[page_num - 1].encode())
+    return digest.hexdigest()
+
+
+def render_quiz_prompt(kind: str, chapter: dict, item_count: int, limited_content: str) -> str:
+    if kind == "flashcards":
+        task = f"""Write {item_count} flashcards covering the key terms, facts and ideas of this chapter.
+Each flashcard has a short "question" (the front: a term or prompt) and an "answer" (the back: a concise definition or explanation)."""
+        example = '{"question": "...", "answer": "...", "source_pages": [12]}'
+    else:
+        task = f"""Write {item_count} multiple-choice quiz questions testing understanding of this chapter.
+Each question has four "options", and the "answer" is the text of the correct option."""
+        example = '{"question": "...", "options": ["...", "...", "...", "..."], "answer": "...", "source_pages": [12]}'
+
+    return f"""You are an educational AI assistant helping teachers build question banks from textbook content.
+
+Chapter: {chapter["title"]} (pages {chapter["start_page"]}-{chapter["end_page"]})
+
+Textbook Content:
+{limited_content}
+
+{task}
+Use ONLY the textbook content above. "source_pages" lists the page numbers the answer comes from.
+
+Respond with a JSON array only, no other text, in this form:
+[{example}]"""
+
+
+def parse_quiz_items(text: str, chapter: dict) -> List[dict]:
+    """Items from the model's JSON reply, keeping only well-formed ones"""
+    text = CODE_FENCE.sub("", (text or "").strip())
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        raise ValueError("Model reply did not contain a JSON array")
+    raw_items = json.loads(text[start:end + 1])
+
+    items = []
+    for raw in raw_items:
+        if not isinstance(raw, dict) or not raw.get("question") or not raw.get("answer"):
+            continue
+        item = {"question": str(raw["question"]).strip(), "answer": str(raw["answer"]).strip()}
+        if isinstance(raw.get("options"), list):
+            item["options"] = [str(option) for option in raw["options"]]
+        pages = raw.get("source_pages") or []
+        item["source_pages"] = sorted({
+            int(page) for page in (pages if isinstance(pages, list) else [pages])
+            if str(page).isdigit() and chapter["start_page"] <= int(page) <= chapter["end_page"]
+        })
+        items.append(item)
+    if not items:
+        raise ValueError("Model reply had no usable items")
+    return items
@@ -0,0 +1,174 @@
+"""
+Hot-textbook residency.
+
+Tracks how often each textbook is used (exponentially decayed, so yesterday's
+rush fades) and keeps the hottest ones resident in process within a memory
+budget: per-page text, per-page token counts and a page retriever, so a
+question against a hot book skips the Mongo fetch, page splitting and
+tokenization. Admins can pin or preload books ahead of a known peak, and the
+most-used books are preloaded at startup from persisted access counts.
+
+There is no prebuilt prompt prefix per book: every endpoint's prompt starts
+with the caller's question or topic, and the pages included are chosen per
+query, so the cacheable parts are the per-page token counts and the retriever.
+"""
+import math
+import os
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+from library_index import LibraryIndex
+from prompting import count_tokens, format_page
+
+RESIDENT_BUDGET_BYTES = int(os.getenv("RESIDENT_BUDGET_MB", 256)) * 1024 * 1024
+# Decayed access score a textbook needs before it's made resident
+HOT_THRESHOLD = float(os.getenv("RESIDENT_HOT_THRESHOLD", 3))
+ACCESS_HALF_LIFE_SECONDS = float(os.getenv("RESIDENT_HALF_LIFE_SECONDS", 3600))
+# Python strings, page lists, token counts and the retriever together cost a few times the raw text
+SIZE_OVERHEAD = 4
+
+
+class ResidentTextbook:
+    def __init__(self, textbook: dict, pages: List[str], pinned: bool = False):
+        self.textbook_id = str(textbook["_id"])
+        # Metadata only; the text lives in `pages`
+        self.textbook = {k: v for k, v in textbook.items() if k != "content"}
+        self.pages = pages
+        self.page_tokens = [count_tokens(format_page(num, text)) for num, text in enumerate(pages, start=1)]
+        self.retriever = LibraryIndex()
+        self.retriever.add_textbook(self.textbook_id, textbook.get("filename", ""), pages)
+        self.size_bytes = sum(len(text) for text in pages) * SIZE_OVERHEAD
+        self.pinned = pinned
+        self.loaded_at = time.time()
+        self.hits = 0
+
+    def rank_pages(self, query: Optional[str], limit: int = 50) -> List[int]:
+        return [hit["page"] for hit in self.retriever.search(query or "", limit)]
+
+
+class ResidentSet:
+    def __init__(self, budget_bytes: int = RESIDENT_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self.residents = {}
+        self.loading = set()
+        self.scores = {}          # textbook_id -> (decayed score, last update time)
+        self.pending_counts = Counter()  # accesses not yet persisted
+
+    def _decayed(self, textbook_id: str, now: float) -> float:
+        score, updated = self.scores.get(textbook_id, (0.0, now))
+        return score * math.pow(0.5, (now - updated) / ACCESS_HALF_LIFE_SECONDS)
+
+    def record_access(self, textbook_id: str) -> float:
+        with self.lock:
+            now = time.time()
+            score = self._decayed(textbook_id, now) + 1
+            self.scores[textbook_id] = (score, now)
+            self.pending_counts[textbook_id] += 1
+            return score
+
+    def score(self, textbook_id: str) -> float:
+        with self.lock:
+            return self._decayed(textbook_id, time.time())
+
+    def get(self, textbook_id: str) -> Optional[ResidentTextbook]:
+        with self.lock:
+            resident = self.residents.get(textbook_id)
+            if resident:
+                resident.hits += 1
+            return resident
+
+    def used_bytes(self) -> int:
+        return sum(r.size_bytes for r in self.residents.values())
+
+    def admit(self, textbook: dict, pages: List[str], pinned: bool = False, force: bool = False) -> Optional[ResidentTextbook]:
+        """
+        Make a textbook resident if it's hot enough (or `force`). Hot books may
+        evict colder unpinned ones and pins may evict any unpinned book; forced
+        loads (warm start, unpinned preloads) only use free space. Returns None
+        if it doesn't fit.
+        """
+        textbook_id = str(textbook["_id"])
+        now = time.time()
+        with self.lock:
+            existing = self.residents.get(textbook_id)
+            if existing:
+                existing.pinned = existing.pinned or pinned
+                return existing
+            if not (force or pinned) and self._decayed(textbook_id, now) < HOT_THRESHOLD:
+                return None
+            if textbook_id in self.loading:
+                return None
+            self.loading.add(textbook_id)
+
+        try:
+            # Build outside the lock - tokenizing a big book takes a moment
+            resident = ResidentTextbook(textbook, pages, pinned=pinned)
+        finally:
+            with self.lock:
+                self.loading.discard(textbook_id)
+
+        with self.lock:
+            if textbook_id in self.residents:
+                return self.residents[textbook_id]
+            if resident.size_bytes > self.budget_bytes:
+                return None
+            score = self._decayed(textbook_id, now)
+            evictable = sorted(
+                (r for r in self.residents.values() if not r.pinned),
+                key=lambda r: self._decayed(r.textbook_id, now)
+            )
+            free = self.budget_bytes - self.used_bytes()
+            victims = []
+            for candidate in evictable:
+                if free >= resident.size_bytes:
+                    break
+                # Only push out books colder than this one (pins may push out anything)
+                if not pinned and self._decayed(candidate.textbook_id, now) >= score:
+                    break
+                victims.append(candidate)
+                free += candidate.size_bytes
+            if free < resident.size_bytes:
+                return None
+            for victim in victims:
+                del self.residents[victim.textbook_id]
+            self.residents[textbook_id] = resident
+            return resident
+
+    def evict(self, textbook_id: str):
+        with self.lock:
+            self.residents.pop(textbook_id, None)
+
+    def unpin(self, textbook_id: str) -> bool:
+        with self.lock:
+            resident = self.residents.get(textbook_id)
+            if resident:
+                resident.pinned = False
+            return resident is not None
+
+    def take_pending_counts(self) -> Counter:
+        with self.lock:
+            counts, self.pending_counts = self.pending_counts, Counter()
+            return counts
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self.lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": self.used_bytes(),
+                "residents": [
+                    {
+                        "textbook_id": r.textbook_id,
+                        "filename": r.textbook.get("filename"),
+                        "size_bytes": r.size_bytes,
+                        "pinned": r.pinned,
+                        "hits": r.hits,
+                        "score": round(self._decayed(r.textbook_id, now), 2),
+                        "loaded_at": r.loaded_at
+                    }
+                    for r in sorted(self.residents.values(), key=lambda r: -self._decayed(r.textbook_id, now))
+                ]
+            }
@@ -0,0 +1,162 @@
+"""
+Password hashing and session helpers.
+
+Passwords are hashed with salted scrypt in a dedicated, size-capped thread pool
+so a burst of logins can't stall the event loop. Legacy unsalted SHA-256 hashes
+are still accepted and upgraded on the next successful login.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+# scrypt cost parameters - N=2**14, r=8 uses ~16MB and ~50ms per hash
+SCRYPT_N = int(os.getenv("PASSWORD_HASH_N", 2 ** 14))
+SCRYPT_R = int(os.getenv("PASSWORD_HASH_R", 8))
+SCRYPT_P = int(os.getenv("PASSWORD_HASH_P", 1))
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+# At most this many hashes run at once; the rest wait their turn
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 4))
+
+SESSION_TTL = timedelta(hours=int(os.getenv("SESSION_TTL_HOURS", 24 * 7)))
+SESSION_CACHE_SECONDS = int(os.getenv("SESSION_CACHE_SECONDS", 60))
+SESSION_CACHE_MAX = 10000
+
+_hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+_hash_slots = None
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=256 * n * r + 1024 * 1024, dklen=KEY_BYTES
+    )
+
+
+def hash_password_sync(password: str) -> str:
+    """Return an encoded hash: scrypt$n$r$p$salt$key"""
+    salt = secrets.token_bytes(SALT_BYTES)
+    key = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(key)}"
+
+
+def is_legacy_hash(stored: str) -> bool:
+    """Old accounts store a bare hex SHA-256 digest"""
+    return not stored.startswith("scrypt$")
+
+
+def needs_rehash(stored: str) -> bool:
+    """True for legacy hashes and for scrypt hashes made with an older cost"""
+    if is_legacy_hash(stored):
+        return True
+    _, n, r, p, _, _ = stored.split("$")
+    return (int(n), int(r), int(p)) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def verify_password_sync(password: str, stored: str) -> bool:
+    if is_legacy_hash(stored):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored)
+    try:
+        _, n, r, p, salt, key = stored.split("$")
+        expected = base64.b64decode(key)
+        actual = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+
+async def _run_in_hash_pool(func, *args):
+    global _hash_slots
+    if _hash_slots is None:
+        _hash_slots = asyncio.Semaphore(HASH_WORKERS)
+    async with _hash_slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_hash_pool, func, *args)
+
+
+async def hash_password(password: str) -> str:
+    return await _run_in_hash_pool(hash_password_sync, password)
+
+
+async def verify_password(password: str, stored: str) -> bool:
+    return await _run_in_hash_pool(verify_password_sync, password, stored)
+
+
+_dummy_hash = None
+
+
+async def verify_unknown_user(password: str) -> bool:
+    """
+    Do a full verify against a throwaway hash when no account matches, so an
+    unknown email takes as long as a wrong password. Always False.
+    """
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = await hash_password(secrets.token_urlsafe(16))
+    await verify_password(password, _dummy_hash)
+    return False
+
+
+def shutdown_hash_pool():
+    _hash_pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Sessions - tokens are only stored as SHA-256 digests
+_session_cache = {}
+
+
+def _token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_session(sessions_collection, user_id: str) -> str:
+    token = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    sessions_collection.insert_one({
+        "token_hash": _token_digest(token),
+        "user_id": user_id,
+        "created_at": now,
+        "expires_at": now + SESSION_TTL
+    })
+    return token
+
+
+def get_session(sessions_collection, token: str) -> Optional[dict]:
+    """Look up a session, serving repeat checks from a short-lived in-process cache"""
+    digest = _token_digest(token)
+    now = time.monotonic()
+
+    cached = _session_cache.get(digest)
+    if cached and cached[0] > now:
+        session = cached[1]
+        if session and session["expires_at"] > datetime.utcnow():
+            return session
+        return None
+
+    session = sessions_collection.find_one({"token_hash": digest})
+    if session and session["expires_at"] <= datetime.utcnow():
+        session = None
+
+    if len(_session_cache) >= SESSION_CACHE_MAX:
+        _session_cache.clear()
+    _session_cache[digest] = (now + SESSION_CACHE_SECONDS, session)
+    return session
+
+
+def delete_session(sessions_collection, token: str):
+    digest = _token_digest(token)
+    sessions_collection.delete_one({"token_hash": digest})
+    _session_cache.pop(digest, None)
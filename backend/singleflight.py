@@ -0,0 +1,70 @@
+"""
+Single-flight coalescing for identical in-flight model calls.
+
+When many clients ask the same thing at once (a question projected in class),
+the first request runs the upstream call and the rest wait on it and share the
+result. A caller that disconnects only stops waiting; the shared call is
+cancelled only once nobody is waiting for it any more.
+"""
+import asyncio
+import hashlib
+import re
+from collections import Counter
+from typing import Awaitable, Callable, Optional
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_input(text: Optional[str]) -> str:
+    """Case, spacing and trailing punctuation don't change what's being asked"""
+    return WHITESPACE.sub(" ", (text or "").strip().lower()).rstrip("?!. ")
+
+
+def coalesce_key(endpoint: str, textbook_id: str, *inputs: Optional[str]) -> str:
+    parts = [endpoint, str(textbook_id)] + [normalize_input(value) for value in inputs]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.counters = Counter()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        """Run fn() once per key at a time; concurrent callers with the same key share the result"""
+        call = self.calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self.calls[key] = call
+            call.task.add_done_callback(lambda _, key=key, call=call: self._forget(key, call))
+            self.counters["upstream_calls"] += 1
+        else:
+            self.counters["coalesced"] += 1
+
+        call.waiters += 1
+        try:
+            # shield: cancelling this caller must not cancel the shared task
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            self.counters["waiters_cancelled"] += 1
+            raise
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Every caller has gone away - stop paying for the upstream call
+                call.task.cancel()
+                self._forget(key, call)
+                self.counters["upstream_cancelled"] += 1
+
+    def _forget(self, key: str, call: _Call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self.calls), **self.counters}
@@ -0,0 +1,232 @@
+"""
+On-disk storage for uploaded PDFs.
+
+Files live under a configurable root as {textbook_id}.pdf and are written
+atomically (temp file, fsync, rename). Textbooks nobody has opened for a while
+can be moved to gzip-compressed cold storage and are restored on next open. A
+periodic reconciler removes files without a database record, and records whose
+file is gone, so disk usage stays predictable.
+"""
+import gzip
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+UPLOADS_DIR = os.getenv("UPLOADS_DIR", "uploads")
+USER_QUOTA_BYTES = int(os.getenv("USER_QUOTA_MB", 500)) * 1024 * 1024  # 0 disables quotas
+COLD_STORAGE_AFTER_DAYS = int(os.getenv("COLD_STORAGE_AFTER_DAYS", 0))  # 0 disables cold storage
+RECONCILE_INTERVAL_SECONDS = int(os.getenv("STORAGE_RECONCILE_SECONDS", 3600))
+
+# Never reap anything younger than this - it may belong to an upload in progress
+ORPHAN_GRACE = timedelta(hours=1)
+# Refuse to delete more than this share of records in one pass (e.g. a wrong UPLOADS_DIR)
+MAX_RECORD_REAP_FRACTION = 0.5
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class StorageManager:
+    def __init__(self, root: str = UPLOADS_DIR):
+        self.root = os.path.abspath(root)
+        self.cold_dir = os.path.join(self.root, "cold")
+        self.tmp_dir = os.path.join(self.root, ".tmp")
+        for directory in (self.root, self.cold_dir, self.tmp_dir):
+            os.makedirs(directory, exist_ok=True)
+
+    def hot_path(self, textbook_id: str) -> str:
+        return os.path.join(self.root, f"{textbook_id}.pdf")
+
+    def cold_path(self, textbook_id: str) -> str:
+        return os.path.join(self.cold_dir, f"{textbook_id}.pdf.gz")
+
+    def write_temp(self, data: bytes) -> str:
+        """Write bytes to a temp file on the same filesystem, ready for an atomic rename"""
+        tmp_path = os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.part")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp_path
+
+    def commit(self, tmp_path: str, textbook_id: str) -> str:
+        path = self.hot_path(textbook_id)
+        os.replace(tmp_path, path)
+        return path
+
+    def discard(self, tmp_path: str):
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def _legacy_path(self, textbook: dict) -> Optional[str]:
+        # Older uploads stored a path relative to the backend directory
+        path = textbook.get("pdf_path")
+        return path if path and os.path.exists(path) else None
+
+    def resolve(self, textbook: dict) -> Optional[str]:
+        """Path of the readable PDF for a textbook, restoring it from cold storage if needed"""
+        textbook_id = str(textbook["_id"])
+        path = self.hot_path(textbook_id)
+        if os.path.exists(path):
+            return path
+        if os.path.exists(self.cold_path(textbook_id)):
+            try:
+                return self.thaw(textbook_id)
+            except FileNotFoundError:
+                # A concurrent request restored it first
+                if os.path.exists(path):
+                    return path
+                raise
+        return self._legacy_path(textbook)
+
+    def read(self, textbook: dict) -> Optional[bytes]:
+        path = self.resolve(textbook)
+        if not path:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def delete(self, textbook: dict):
+        """Remove every stored copy of a textbook's PDF"""
+        textbook_id = str(textbook["_id"])
+        for path in (self.hot_path(textbook_id), self.cold_path(textbook_id), self._legacy_path(textbook)):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def freeze(self, textbook_id: str):
+        """Move a PDF to compressed cold storage"""
+        hot = self.hot_path(textbook_id)
+        tmp_path = os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.gz.part")
+        with open(hot, "rb") as src, gzip.open(tmp_path, "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, self.cold_path(textbook_id))
+        os.remove(hot)
+
+    def thaw(self, textbook_id: str) -> str:
+        """Restore a PDF from cold storage"""
+        tmp_path = os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.part")
+        with gzip.open(self.cold_path(textbook_id), "rb") as src, open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        path = self.commit(tmp_path, textbook_id)
+        os.remove(self.cold_path(textbook_id))
+        return path
+
+    def file_size(self, textbook: dict) -> Optional[int]:
+        """Uncompressed size of a textbook's PDF, wherever it is stored"""
+        textbook_id = str(textbook["_id"])
+        hot = self.hot_path(textbook_id)
+        if os.path.exists(hot):
+            return os.path.getsize(hot)
+        cold = self.cold_path(textbook_id)
+        if os.path.exists(cold):
+            # gzip's trailer holds the uncompressed size (mod 4GB, far above any PDF we accept)
+            with open(cold, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                return int.from_bytes(f.read(4), "little")
+        legacy = self._legacy_path(textbook)
+        return os.path.getsize(legacy) if legacy else None
+
+    def stored_ids(self) -> dict:
+        """textbook_id -> file path for everything on disk"""
+        files = {}
+        for directory, suffix in ((self.root, ".pdf"), (self.cold_dir, ".pdf.gz")):
+            for name in os.listdir(directory):
+                if name.endswith(suffix):
+                    files[name[:-len(suffix)]] = os.path.join(directory, name)
+        return files
+
+
+def check_quota(textbooks_collection, user_id: Optional[str], new_bytes: int):
+    """
+    Raise QuotaExceeded if storing new_bytes would put the user over their quota.
+    Usage is summed from the records, so parallel uploads can all pass this check;
+    the upload handler checks again (with new_bytes=0) once its record is inserted.
+    """
+    if not user_id or not USER_QUOTA_BYTES:
+        return
+    used = user_storage_used(textbooks_collection, user_id)
+    if used + new_bytes > USER_QUOTA_BYTES:
+        raise QuotaExceeded(
+            f"Storage quota exceeded: {used // (1024 * 1024)}MB of {USER_QUOTA_BYTES // (1024 * 1024)}MB used"
+        )
+
+
+def user_storage_used(textbooks_collection, user_id: str) -> int:
+    result = list(textbooks_collection.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$group": {"_id": None, "total": {"$sum": "$file_size"}}}
+    ]))
+    return result[0]["total"] if result else 0
+
+
+def _older_than(path: str, age: timedelta) -> bool:
+    return time.time() - os.path.getmtime(path) > age.total_seconds()
+
+
+def reconcile(storage: StorageManager, textbooks_collection, on_record_removed: Callable[[dict], None]) -> dict:
+    """
+    One pass of storage housekeeping:
+    - delete stale temp files and files with no textbook record
+    - delete textbook records whose file is gone (via on_record_removed)
+    - record file_size on textbooks uploaded before quotas, so they count towards usage
+    - move textbooks not opened in COLD_STORAGE_AFTER_DAYS to cold storage
+    """
+    stats = {"temp_files": 0, "orphan_files": 0, "orphan_records": 0, "sized": 0, "frozen": 0}
+    now = datetime.utcnow()
+
+    for name in os.listdir(storage.tmp_dir):
+        path = os.path.join(storage.tmp_dir, name)
+        if _older_than(path, ORPHAN_GRACE):
+            os.remove(path)
+            stats["temp_files"] += 1
+
+    files = storage.stored_ids()
+    records = {
+        str(doc["_id"]): doc
+        for doc in textbooks_collection.find({}, {"pdf_path": 1, "uploaded_at": 1, "last_opened_at": 1, "user_id": 1, "file_size": 1})
+    }
+
+    for textbook_id, path in files.items():
+        if textbook_id not in records and _older_than(path, ORPHAN_GRACE):
+            os.remove(path)
+            stats["orphan_files"] += 1
+
+    missing = [
+        doc for textbook_id, doc in records.items()
+        if textbook_id not in files
+        and not storage._legacy_path(doc)
+        and doc.get("uploaded_at", now) < now - ORPHAN_GRACE
+    ]
+    if missing and (not files or len(missing) > max(10, len(records) * MAX_RECORD_REAP_FRACTION)):
+        print(f"Warning: {len(missing)} of {len(records)} textbooks have no PDF under {storage.root}; "
+              f"not removing records - check UPLOADS_DIR")
+    else:
+        for doc in missing:
+            on_record_removed(doc)
+            stats["orphan_records"] += 1
+
+    for doc in records.values():
+        if doc.get("file_size") is None:
+            size = storage.file_size(doc)
+            if size is not None:
+                textbooks_collection.update_one(
+                    {"_id": doc["_id"], "file_size": {"$exists": False}}, {"$set": {"file_size": size}}
+                )
+                stats["sized"] += 1
+
+    if COLD_STORAGE_AFTER_DAYS:
+        cutoff = now - timedelta(days=COLD_STORAGE_AFTER_DAYS)
+        for textbook_id, doc in records.items():
+            last_opened = doc.get("last_opened_at") or doc.get("uploaded_at") or now
+            if last_opened < cutoff and os.path.exists(storage.hot_path(textbook_id)):
+                storage.freeze(textbook_id)
+                stats["frozen"] += 1
+
+    return stats
+
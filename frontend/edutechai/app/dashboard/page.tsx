@@ -22,6 +22,7 @@ interface Message {
   isExplanation?: boolean;
   pageNumber?: number;
   timestamp?: string;
+  conversationId?: string;
 }
 
 interface Conversation {
@@ -214,7 +215,8 @@ export default function Home() {
               type: 'assistant',
               content: conv.answer!,
               pageNumber: conv.page_number || undefined,
-              timestamp: conv.timestamp
+              timestamp: conv.timestamp,
+              conversationId: conv._id
             });
           });
         setMessages(historyMessages.reverse());
@@ -444,7 +446,8 @@ export default function Home() {
         type: 'assistant', 
         content: data.answer,
         pageNumber: data.page_number || undefined,
-        isExplanation: false
+        isExplanation: false,
+        conversationId: data.conversation_id
       }]);
 
       // If page number is available, show that page
@@ -465,7 +468,7 @@ export default function Home() {
     }
   };
 
-  const handleExplain = async (answer: string, questionText: string) => {
+  const handleExplain = async (answer: string, questionText: string, conversationId?: string) => {
     if (!selectedTextbook) return;
 
     setExplaining(true);
@@ -480,6 +483,7 @@ export default function Home() {
           textbook_id: selectedTextbook,
           answer: answer,
           question: questionText,
+          conversation_id: conversationId,
         }),
       });
 
@@ -516,7 +520,7 @@ export default function Home() {
       if (conv.question && conv.answer) {
         setMessages([
           { type: 'user', content: conv.question, timestamp: conv.timestamp },
-          { type: 'assistant', content: conv.answer, pageNumber: conv.page_number || undefined, timestamp: conv.timestamp }
+          { type: 'assistant', content: conv.answer, pageNumber: conv.page_number || undefined, timestamp: conv.timestamp, conversationId: conv._id }
         ]);
         if (conv.page_number) {
           setCurrentPage(conv.page_number);
@@ -904,7 +908,7 @@ export default function Home() {
                               const questionText = questionIndex >= 0 
                                 ? messages[questionIndex].content 
                                 : '';
-                              handleExplain(message.content, questionText);
+                              handleExplain(message.content, questionText, message.conversationId);
                             }}
                             disabled={explaining}
                             className={`mt-2 text-xs hover:underline disabled:opacity-50 flex items-center gap-1 ${